@@ -58,8 +58,6 @@ from .globals import default_distro
 
 from . import list_ops  # noqa: F401
 
-base_dir = os.path.realpath(sys.argv[1])
-
 
 @command(
     name="list-rpms",
@@ -629,6 +627,7 @@ def prepare_reseal(args, tmpdir, runner):
 
 
 def main():
+    base_dir = os.path.realpath(sys.argv[1])
     parsed_args = parse_args(sys.argv[2:])
     args = AIBParameters(parsed_args, base_dir)
 
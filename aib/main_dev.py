@@ -32,8 +32,6 @@ from .osbuild import (
 
 from . import list_ops  # noqa: F401
 
-base_dir = os.path.realpath(sys.argv[1])
-
 
 @command(
     name="list-rpms",
@@ -215,6 +213,7 @@ def download(args, tmpdir, runner):
 
 
 def main():
+    base_dir = os.path.realpath(sys.argv[1])
     parsed_args = parse_args(sys.argv[2:], prog="aib-dev")
     args = AIBParameters(parsed_args, base_dir)
 
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+import copy
+import fnmatch
+import functools
+import json
 import os
 import yaml
 import re
@@ -8,6 +12,16 @@ from enum import Enum
 
 import jsonschema
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 from . import exceptions, log
 
 
@@ -74,6 +88,69 @@ def json_bool(b):
     return "false"
 
 
+def _is_recursive_glob(source_glob):
+    """Check if the glob pattern is recursive (contains /**/)"""
+    return source_glob.endswith("/**/*") or "/**/*" in source_glob
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_glob_component(pattern):
+    return re.compile(fnmatch.translate(pattern))
+
+
+def _walk_recursive_glob(glob_pattern):
+    """Match a 'prefix/**/name' glob pattern in a single os.walk() pass
+
+    This returns the same paths, in the same order, as
+    glob.glob(glob_pattern, recursive=True). Returns None for patterns
+    of any other form, which then need to use glob.glob().
+    """
+    prefix, sep, name = glob_pattern.partition("/**/")
+    if not sep or glob.has_magic(prefix) or "/" in name or "**" in name:
+        return None
+
+    match = _compile_glob_component(name).match
+    # Like glob, don't match hidden files unless the pattern asks for them
+    match_hidden = name.startswith(".")
+
+    matches = []
+    for root, dirs, files in os.walk(prefix or "/", followlinks=True):
+        # '**' never recurses into hidden directories
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if match(f) and (match_hidden or not f.startswith(".")):
+                matches.append(os.path.join(root, f))
+    return matches
+
+
+# The base directory only depends on the pattern, so cache it instead of
+# redoing the string processing for every matched file.
+@functools.lru_cache(maxsize=256)
+def _glob_base_dir(basedir, source_glob):
+    """Get the directory that preserved glob destination paths are relative to"""
+    if os.path.isabs(source_glob):
+        glob_base = source_glob.split("*")[0].rstrip("/")
+        return os.path.dirname(glob_base)
+
+    if ".." in source_glob:
+        # Globs with parent directory references like '../aib/**/*.py'
+        glob_prefix = source_glob.split("*")[0].rstrip("/")
+        return os.path.normpath(os.path.join(basedir, glob_prefix))
+
+    if _is_recursive_glob(source_glob):
+        # Recursive globs like 'test-data/**/*' or 'test-data/**/*.py'
+        if source_glob.endswith("/**/*"):
+            glob_prefix = source_glob[:-5]  # Remove '/**/*'
+        else:
+            glob_prefix = source_glob.split("/**/*")[0]
+
+        if glob_prefix:
+            return os.path.normpath(os.path.join(basedir, glob_prefix))
+
+    # Normal globs like 'files/*.conf', no prefix, use basedir
+    return basedir
+
+
 # The manifest we use is always empty.mpp.yml, but due to who the
 # osbuil-mpp syntax and evaluation works we need to also generate an
 # extra manifest with the included file content. This is shared betwee
@@ -180,13 +257,22 @@ class ExtraInclude:
                 source_glob, len(matched_files), max_files
             )
 
-        for file_path in matched_files:
-            dest_path = self._calculate_destination_path(
-                file_path, source_glob, dest_dir, preserve_path
-            )
+        if preserve_path:
+            # Files in the same directory share the relative path of their parent
+            rel_parents = {}
+        else:
+            # Destinations are absolute POSIX paths, so a flattened destination
+            # is just the directory and file name joined with a slash.
+            flat_dest_dir = dest_dir.rstrip("/")
 
+        for file_path in matched_files:
             if preserve_path:
+                dest_path = self._calculate_destination_path(
+                    file_path, source_glob, dest_dir, rel_parents
+                )
                 self._ensure_parent_directory(contents, dest_path, dest_dir)
+            else:
+                dest_path = f"{flat_dest_dir}/{os.path.basename(file_path)}"
 
             file_data = {"source_path": file_path, "path": dest_path}
             self._add_file_to_content(contents, file_data)
@@ -199,9 +285,15 @@ class ExtraInclude:
         else:
             glob_pattern = source_glob
 
-        matched_files = [
-            f for f in glob.glob(glob_pattern, recursive=True) if os.path.isfile(f)
-        ]
+        if not glob.has_magic(glob_pattern):
+            # A literal path, there is nothing to expand
+            candidates = [glob_pattern]
+        else:
+            candidates = _walk_recursive_glob(glob_pattern)
+            if candidates is None:
+                candidates = glob.glob(glob_pattern, recursive=True)
+
+        matched_files = [f for f in candidates if os.path.isfile(f)]
 
         if not matched_files:
             raise exceptions.NoMatchingFilesError(source_glob)
@@ -209,71 +301,24 @@ class ExtraInclude:
         return matched_files
 
     def _calculate_destination_path(
-        self, file_path, source_glob, dest_dir, preserve_path
+        self, file_path, source_glob, dest_dir, rel_parents
     ):
-        """Calculate the destination path for a file based on preserve_path setting"""
-        if not preserve_path:
-            # Flatten: just use the filename
-            return os.path.join(dest_dir, os.path.basename(file_path))
-
-        # Preserve directory structure
-        if os.path.isabs(source_glob):
-            return self._calculate_absolute_glob_dest_path(
-                file_path, source_glob, dest_dir
-            )
-        else:
-            return self._calculate_relative_glob_dest_path(
-                file_path, source_glob, dest_dir
-            )
-
-    def _calculate_relative_glob_dest_path(self, file_path, source_glob, dest_dir):
-        """Calculate destination path for relative glob patterns"""
-        if ".." in source_glob:
-            return self._handle_parent_directory_glob(file_path, source_glob, dest_dir)
-        elif self._is_recursive_glob(source_glob):
-            return self._handle_recursive_glob(file_path, source_glob, dest_dir)
-        else:
-            return self._handle_normal_glob(file_path, dest_dir)
-
-    def _calculate_absolute_glob_dest_path(self, file_path, source_glob, dest_dir):
-        """Calculate destination path for absolute glob patterns"""
-        glob_pattern = source_glob
-        glob_base = os.path.dirname(glob_pattern.split("*")[0].rstrip("/"))
-        rel_path = os.path.relpath(file_path, glob_base)
-        return os.path.normpath(os.path.join(dest_dir, rel_path))
+        """Calculate the destination path for a file, preserving directory structure
 
-    def _handle_parent_directory_glob(self, file_path, source_glob, dest_dir):
-        """Handle globs with parent directory references like '../aib/**/*.py'"""
-        glob_prefix = source_glob.split("*")[0].rstrip("/")
-        base_dir = os.path.normpath(os.path.join(self.basedir, glob_prefix))
-        rel_path = os.path.relpath(file_path, base_dir)
-        return os.path.normpath(os.path.join(dest_dir, rel_path))
-
-    def _handle_recursive_glob(self, file_path, source_glob, dest_dir):
-        """Handle recursive globs like 'test-data/**/*' or 'test-data/**/*.py'"""
-        if source_glob.endswith("/**/*"):
-            glob_prefix = source_glob[:-5]  # Remove '/**/*'
-        else:
-            # Handle cases like "test-data/**/*.py"
-            glob_prefix = source_glob.split("/**/*")[0]
-
-        if glob_prefix:
-            base_dir = os.path.normpath(os.path.join(self.basedir, glob_prefix))
-            rel_path = os.path.relpath(file_path, base_dir)
-        else:
-            # No prefix, use basedir
-            rel_path = os.path.relpath(file_path, self.basedir)
-
-        return os.path.normpath(os.path.join(dest_dir, rel_path))
-
-    def _handle_normal_glob(self, file_path, dest_dir):
-        """Handle normal glob patterns like 'files/*.conf'"""
-        rel_path = os.path.relpath(file_path, self.basedir)
-        return os.path.normpath(os.path.join(dest_dir, rel_path))
-
-    def _is_recursive_glob(self, source_glob):
-        """Check if the glob pattern is recursive (contains /**/)"""
-        return source_glob.endswith("/**/*") or "/**/*" in source_glob
+        rel_parents caches the relative path of each parent directory seen so
+        far, so os.path.relpath() runs once per directory rather than per file.
+        """
+        parent, filename = os.path.split(file_path)
+        rel_parent = rel_parents.get(parent)
+        if rel_parent is None:
+            base_dir = _glob_base_dir(self.basedir, source_glob)
+            rel_parent = os.path.relpath(parent, base_dir)
+            if ".." in rel_parent.split(os.sep):
+                # The file is outside the glob base, which would place it
+                # outside dest_dir, so fall back to using just the filename
+                rel_parent = ""
+            rel_parents[parent] = rel_parent
+        return os.path.normpath(os.path.join(dest_dir, rel_parent, filename))
 
     def _ensure_parent_directory(self, contents, dest_path, dest_dir):
         """Ensure parent directories are created when preserving paths"""
@@ -475,25 +520,161 @@ def extend_with_default(validator_class):
     )
 
 
+# Note: Draft7 is what osbuild uses, and is available in rhel9
+_DefaultingDraft7Validator = extend_with_default(jsonschema.Draft7Validator)
+
+
+# These apply depending on whether the instance is valid against their
+# subschemas, so defaults below them are filled in by jsonschema.
+_DEFAULTS_VIA_JSONSCHEMA = ("allOf", "anyOf", "oneOf", "not", "if", "dependencies")
+
+
+# fastjsonschema generates python code specialized for the schema, which
+# validates a lot faster than jsonschema. However, it stops at the first
+# error, so for invalid instances we use the jsonschema validator to
+# report all the errors.
+#
+# Defaults are not filled in by fastjsonschema, as it doesn't handle them
+# the same way as extend_with_default (e.g. the default next to the $ref
+# for the top-level network). Instead set_defaults walks the schema the
+# same way jsonschema does, skipping the parts without any defaults.
+class _FastValidator:
+    def __init__(self, schema, validator):
+        # compile() rewrites the $refs in the schema it is passed
+        self.validate = fastjsonschema.compile(copy.deepcopy(schema), use_default=False)
+        self.schema = schema
+        self.validator = validator
+        self._has_defaults = {}
+
+    def iter_errors(self, instance):
+        self.set_defaults(self.schema, instance)
+        try:
+            self.validate(instance)
+        except fastjsonschema.JsonSchemaException:
+            yield from self.validator.iter_errors(instance)
+
+    def resolve(self, ref):
+        schema = self.schema
+        for part in ref[2:].split("/"):
+            schema = schema[part.replace("~1", "/").replace("~0", "~")]
+        return schema
+
+    def has_defaults(self, schema):
+        key = id(schema)
+        if key not in self._has_defaults:
+            # Assume there are defaults while looking, for recursive $refs
+            self._has_defaults[key] = True
+            self._has_defaults[key] = self._find_defaults(schema)
+        return self._has_defaults[key]
+
+    def _find_defaults(self, schema):
+        if isinstance(schema, list):
+            return any(self.has_defaults(s) for s in schema)
+        if not isinstance(schema, dict):
+            return False
+        if "default" in schema:
+            return True
+        ref = schema.get("$ref")
+        if isinstance(ref, str):
+            if not ref.startswith("#/") or self.has_defaults(self.resolve(ref)):
+                return True
+        return any(
+            self.has_defaults(v) for v in schema.values() if isinstance(v, (dict, list))
+        )
+
+    def set_defaults(self, schema, instance):
+        if not isinstance(schema, dict) or not self.has_defaults(schema):
+            return
+
+        # Like jsonschema for draft7, ignore everything next to a $ref
+        if "$ref" in schema:
+            if schema["$ref"].startswith("#/"):
+                self.set_defaults(self.resolve(schema["$ref"]), instance)
+            else:
+                list(self.validator.descend(instance, schema))
+            return
+
+        is_object = isinstance(instance, dict)
+        for keyword, value in schema.items():
+            if keyword == "properties" and is_object:
+                for property, subschema in value.items():
+                    if isinstance(subschema, dict) and "default" in subschema:
+                        instance.setdefault(property, subschema["default"])
+                for property, subschema in value.items():
+                    if property in instance:
+                        self.set_defaults(subschema, instance[property])
+            elif keyword == "patternProperties" and is_object:
+                for pattern, subschema in value.items():
+                    for property, v in instance.items():
+                        if re.search(pattern, property):
+                            self.set_defaults(subschema, v)
+            elif keyword == "additionalProperties" and is_object:
+                properties = schema.get("properties", {})
+                patterns = "|".join(schema.get("patternProperties", {}))
+                for property, v in instance.items():
+                    if property in properties:
+                        continue
+                    if patterns and re.search(patterns, property):
+                        continue
+                    self.set_defaults(value, v)
+            elif keyword == "items" and isinstance(instance, list):
+                if isinstance(value, list):
+                    for subschema, item in zip(value, instance):
+                        self.set_defaults(subschema, item)
+                else:
+                    for item in instance:
+                        self.set_defaults(value, item)
+            elif keyword in _DEFAULTS_VIA_JSONSCHEMA:
+                subschema = {keyword: value}
+                if keyword == "if":
+                    for k in ("then", "else"):
+                        if k in schema:
+                            subschema[k] = schema[k]
+                if any(self.has_defaults(s) for s in subschema.values()):
+                    list(self.validator.descend(instance, subschema))
+
+
+# The schema file doesn't change during a run, so only parse it once
+@functools.lru_cache(maxsize=8)
+def _load_schema_json(path):
+    with open(path, mode="r") as file:
+        return json.dumps(yaml.load(file, SafeLoader), sort_keys=True)
+
+
+# Checking the schema and creating the validator is costly, and the schema is
+# the same for every ManifestLoader, so share the validator between them.
+# The schema is passed as (sorted) json to make it hashable.
+@functools.lru_cache(maxsize=8)
+def _compile_validator(schema_json):
+    schema = json.loads(schema_json)
+
+    _DefaultingDraft7Validator.check_schema(schema)
+    validator = _DefaultingDraft7Validator(schema)
+
+    if fastjsonschema is not None:
+        try:
+            return _FastValidator(schema, validator)
+        except fastjsonschema.JsonSchemaDefinitionException as e:
+            log.debug("Not using fastjsonschema for validation: %s", e)
+
+    return validator
+
+
 class ManifestLoader:
-    def __init__(self, defines, policy=None):
+    def __init__(self, defines, policy=None, validator=None):
         self.aib_basedir = defines["_basedir"]
         self.workdir = defines["_workdir"]
         self.defines = defines
         self.policy = policy
 
-        # Note: Draft7 is what osbuild uses, and is available in rhel9
-        base_cls = jsonschema.Draft7Validator
-        validator_cls = extend_with_default(base_cls)
-
-        with open(
-            os.path.join(self.aib_basedir, "files/manifest_schema.yml"),
-            mode="r",
-        ) as file:
-            self.aib_schema = yaml.load(file, yaml.SafeLoader)
-            base_cls.check_schema(self.aib_schema)
+        if validator is None:
+            validator = _compile_validator(
+                _load_schema_json(
+                    os.path.join(self.aib_basedir, "files/manifest_schema.yml")
+                )
+            )
 
-        self.validator = validator_cls(self.aib_schema)
+        self.validator = validator
 
     def set(self, key, value):
         if (isinstance(value, list) or isinstance(value, dict)) and len(value) == 0:
@@ -607,7 +788,7 @@ class ManifestLoader:
     def load(self, path, manifest_basedir):
         with open(path, mode="r") as f:
             try:
-                manifest = yaml.safe_load(f)
+                manifest = yaml.load(f, SafeLoader)
             except yaml.YAMLError as exc:
                 raise exceptions.ManifestParseError(manifest_basedir) from exc
 
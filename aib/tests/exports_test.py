@@ -1,5 +1,6 @@
 import unittest
 import os
+import shutil
 import tempfile
 from unittest.mock import Mock, patch
 
@@ -56,8 +57,6 @@ class TestExport(unittest.TestCase):
         os.makedirs(self.outputdir)
 
     def tearDown(self):
-        import shutil
-
         shutil.rmtree(self.tmpdir, ignore_errors=True)
 
     def test_export_basic_file(self):
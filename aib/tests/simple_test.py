@@ -1,3 +1,7 @@
+import copy
+import glob
+import io
+import json
 import pytest
 import unittest
 import tempfile
@@ -5,7 +9,7 @@ import os
 import shutil
 import yaml
 import jsonschema
-from unittest.mock import Mock, patch, mock_open
+from unittest.mock import Mock, patch
 
 from aib import exceptions
 from aib.simple import (
@@ -17,24 +21,25 @@ from aib.simple import (
     QMContents,
     ManifestLoader,
     extend_with_default,
+    _compile_validator,
+    _load_schema_json,
+    _DefaultingDraft7Validator,
+    _FastValidator,
+    fastjsonschema,
 )
 from aib.policy import Policy
 
 
-@pytest.mark.parametrize(
-    "orig,key,res",
-    [
+def test_without():
+    for orig, key, res in [
         ({"a": 17, "b": 42}, "b", {"a": 17}),
         ({"a": 17, "b": 42}, "a", {"b": 42}),
-    ],
-)
-def test_without(orig, key, res):
-    assert without(orig, key) == res
+    ]:
+        assert without(orig, key) == res, (orig, key)
 
 
-@pytest.mark.parametrize(
-    "s,res",
-    [
+def test_parse_string():
+    for s, res in [
         ("2kB", 1000 * 2),
         ("2KiB", 1024 * 2),
         ("2MB", 1000 * 1000 * 2),
@@ -44,10 +49,8 @@ def test_without(orig, key, res):
         ("2TB", 1000 * 1000 * 1000 * 1000 * 2),
         ("2TiB", 1024 * 1024 * 1024 * 1024 * 2),
         ("42", 42),  # Test plain number
-    ],
-)
-def test_parse_string(s, res):
-    assert parse_size(s) == res
+    ]:
+        assert parse_size(s) == res, (s, res)
 
 
 def test_parse_unsupported_string():
@@ -58,9 +61,9 @@ def test_parse_unsupported_string():
         parse_size("2Kg")
 
 
-@pytest.mark.parametrize(
-    "value,expected",
-    [
+def test_json_bool():
+    """Test json_bool function with various inputs"""
+    for value, expected in [
         (True, "true"),
         (False, "false"),
         (1, "true"),
@@ -70,11 +73,8 @@ def test_parse_unsupported_string():
         ([], "false"),
         ([1], "true"),
         (None, "false"),
-    ],
-)
-def test_json_bool(value, expected):
-    """Test json_bool function with various inputs"""
-    assert json_bool(value) == expected
+    ]:
+        assert json_bool(value) == expected, value
 
 
 @pytest.mark.parametrize(
@@ -99,7 +99,7 @@ def test_json_bool(value, expected):
 )
 def test_validate_add_files_paths(path, should_be_valid):
     """Test path validation for add_files (only /etc and /usr allowed)"""
-    mock_loader = Mock()
+    mock_loader = Mock(spec_set=ManifestLoader)
     extra_include = ExtraInclude("/tmp/test-basedir")
 
     if should_be_valid:
@@ -137,7 +137,7 @@ def test_validate_add_files_paths(path, should_be_valid):
 )
 def test_validate_make_dirs_paths(path, should_be_valid):
     """Test path validation for make_dirs (/etc, /usr, and /var allowed)"""
-    mock_loader = Mock()
+    mock_loader = Mock(spec_set=ManifestLoader)
     extra_include = ExtraInclude("/tmp/test-basedir")
 
     if should_be_valid:
@@ -154,13 +154,19 @@ def test_validate_make_dirs_paths(path, should_be_valid):
 
 
 class TestExtraInclude(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # ExtraInclude only records basedir, so one directory per class is enough
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.relative_source_path = os.path.join(cls.tmpdir, "subdir", "file.txt")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
     def setUp(self):
-        self.tmpdir = tempfile.mkdtemp()
         self.extra_include = ExtraInclude(self.tmpdir)
 
-    def tearDown(self):
-        shutil.rmtree(self.tmpdir, ignore_errors=True)
-
     def test_init(self):
         """Test ExtraInclude initialization"""
         self.assertEqual(self.extra_include.basedir, os.path.abspath(self.tmpdir))
@@ -205,11 +211,13 @@ class TestExtraInclude(unittest.TestCase):
         """Test gen_file_input with relative source path"""
         data = {"source_path": "subdir/file.txt"}
         result = self.extra_include.gen_file_input(3, data)
-        expected_path = os.path.normpath(os.path.join(self.tmpdir, "subdir/file.txt"))
         expected = {
             "type": "org.osbuild.files",
             "origin": "org.osbuild.source",
-            "mpp-embed": {"id": "image_content_id_3", "path": expected_path},
+            "mpp-embed": {
+                "id": "image_content_id_3",
+                "path": self.relative_source_path,
+            },
         }
         self.assertEqual(result, expected)
 
@@ -248,18 +256,36 @@ class TestExtraInclude(unittest.TestCase):
 
     def test_add_file_copy(self):
         """Test add_file_copy"""
-        mock_contents = Mock()
-        mock_contents.file_content_copy = []
+        mock_contents = _MockContents()
 
         data = {"text": "content", "path": "/etc/test.txt"}
         self.extra_include.add_file_copy(mock_contents, data)
 
-        # Check that file_content_inputs was populated
-        self.assertIn("inlinefile1", self.extra_include.file_content_inputs)
-        # Check that file_content_paths was populated
-        self.assertEqual(len(self.extra_include.file_content_paths), 1)
-        # Check that contents.file_content_copy was populated
-        self.assertEqual(len(mock_contents.file_content_copy), 1)
+        self.assertEqual(
+            self.extra_include.file_content_inputs,
+            {
+                "inlinefile1": {
+                    "type": "org.osbuild.files",
+                    "origin": "org.osbuild.source",
+                    "mpp-embed": {"id": "image_content_id_1", "text": "content"},
+                }
+            },
+        )
+        self.assertEqual(
+            self.extra_include.file_content_paths,
+            [
+                {
+                    "from": {
+                        "mpp-format-string": "input://inlinefile1/{embedded['image_content_id_1']}"
+                    },
+                    "to": "tree:///image_content_1",
+                }
+            ],
+        )
+        self.assertEqual(
+            mock_contents.file_content_copy,
+            [{"from": "input://extra/image_content_1", "to": "tree:///etc/test.txt"}],
+        )
 
     def test_generate_empty(self):
         """Test generate with no file content"""
@@ -269,8 +295,7 @@ class TestExtraInclude(unittest.TestCase):
 
     def test_generate_with_content(self):
         """Test generate with file content"""
-        mock_contents = Mock()
-        mock_contents.file_content_copy = []
+        mock_contents = _MockContents()
 
         data = {"text": "content", "path": "/etc/test.txt"}
         self.extra_include.add_file_copy(mock_contents, data)
@@ -289,15 +314,23 @@ class TestExtraInclude(unittest.TestCase):
 
 
 class TestContents(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.mock_loader = Mock(spec=ManifestLoader)
+        cls.mock_loader.defines = {"arch": "x86_64"}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
     def setUp(self):
-        self.tmpdir = tempfile.mkdtemp()
-        self.mock_loader = Mock()
-        self.mock_loader.defines = {"arch": "x86_64"}
-        self.mock_loader.set = Mock()
+        self.mock_loader.reset_mock()
         self.extra_include = ExtraInclude(self.tmpdir)
 
-    def tearDown(self):
-        shutil.rmtree(self.tmpdir, ignore_errors=True)
+    def set_calls(self):
+        """Return the loader.set() calls made so far as a key -> value dict"""
+        return dict(c.args for c in self.mock_loader.set.call_args_list)
 
     def test_init(self):
         """Test Contents initialization"""
@@ -341,33 +374,28 @@ class TestContents(unittest.TestCase):
 
         # Check that podman was added to rpms
         expected_rpms = ["vim", "podman"]
-        self.mock_loader.set.assert_any_call("simple_rpms", expected_rpms)
-        self.mock_loader.set.assert_any_call("use_containers_extra_store", True)
-
-    def test_set_defines_with_debug_repos(self):
-        """Test set_defines with debug repos"""
-        data = {"enable_repos": ["debug"]}
-        contents = Contents(self.mock_loader, data, self.extra_include)
-        contents.set_defines()
-
-        self.mock_loader.set.assert_any_call("simple_add_debug_repos", True)
-
-    def test_set_defines_with_devel_repos(self):
-        """Test set_defines with devel repos"""
-        data = {"enable_repos": ["devel"]}
-        contents = Contents(self.mock_loader, data, self.extra_include)
-        contents.set_defines()
-
-        self.mock_loader.set.assert_any_call("simple_add_devel_repos", True)
-
-    def test_set_defines_with_arch_substitution(self):
-        """Test set_defines with arch substitution in repo URLs"""
-        data = {"repos": [{"baseurl": "http://example.com/$arch/repo"}]}
-        contents = Contents(self.mock_loader, data, self.extra_include)
-        contents.set_defines()
-
-        expected_repos = [{"baseurl": "http://example.com/x86_64/repo"}]
-        self.mock_loader.set.assert_any_call("simple_repos", expected_repos)
+        calls = self.set_calls()
+        self.assertEqual(calls["simple_rpms"], expected_rpms)
+        self.assertEqual(calls["use_containers_extra_store"], True)
+
+    def test_set_defines_simple(self):
+        """Test set_defines for content that maps to a single define"""
+        for data, key, expected in [
+            ({"enable_repos": ["debug"]}, "simple_add_debug_repos", True),
+            ({"enable_repos": ["devel"]}, "simple_add_devel_repos", True),
+            # $arch is substituted in repo URLs
+            (
+                {"repos": [{"baseurl": "http://example.com/$arch/repo"}]},
+                "simple_repos",
+                [{"baseurl": "http://example.com/x86_64/repo"}],
+            ),
+        ]:
+            with self.subTest(key=key):
+                self.mock_loader.reset_mock()
+                contents = Contents(self.mock_loader, data, self.extra_include)
+                contents.set_defines()
+
+                self.assertEqual(self.set_calls()[key], expected)
 
     def test_set_defines_with_files(self):
         """Test set_defines with file operations"""
@@ -380,27 +408,30 @@ class TestContents(unittest.TestCase):
         contents = Contents(self.mock_loader, data, self.extra_include)
         contents.set_defines()
 
-        self.mock_loader.set.assert_any_call("simple_mkdir", [{"path": "/etc/test"}])
-        self.mock_loader.set.assert_any_call(
-            "simple_chmod", {"/etc/test": {"mode": "755"}}
-        )
-        self.mock_loader.set.assert_any_call(
-            "simple_chown", {"/etc/test": {"owner": "root", "group": "root"}}
+        calls = self.set_calls()
+        self.assertEqual(calls["simple_mkdir"], [{"path": "/etc/test"}])
+        self.assertEqual(calls["simple_chmod"], {"/etc/test": {"mode": "755"}})
+        self.assertEqual(
+            calls["simple_chown"], {"/etc/test": {"owner": "root", "group": "root"}}
         )
-        self.mock_loader.set.assert_any_call("simple_remove", ["/etc/old"])
+        self.assertEqual(calls["simple_remove"], ["/etc/old"])
 
 
 class TestQMContents(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.mock_loader = Mock(spec=ManifestLoader)
+        cls.mock_loader.defines = {"arch": "x86_64"}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
     def setUp(self):
-        self.tmpdir = tempfile.mkdtemp()
-        self.mock_loader = Mock()
-        self.mock_loader.defines = {"arch": "x86_64"}
-        self.mock_loader.set = Mock()
+        self.mock_loader.reset_mock()
         self.extra_include = ExtraInclude(self.tmpdir)
 
-    def tearDown(self):
-        shutil.rmtree(self.tmpdir, ignore_errors=True)
-
     def test_get_key_with_use_prefix(self):
         """Test QMContents get_key with use_ prefix"""
         qm_contents = QMContents(self.mock_loader, {}, self.extra_include)
@@ -415,6 +446,15 @@ class TestQMContents(unittest.TestCase):
 class TestManifestPolicyValidation(unittest.TestCase):
     """Test policy-based manifest validation in ManifestLoader."""
 
+    @classmethod
+    def setUpClass(cls):
+        # _load() writes extra-include.ipp.yml into the workdir
+        cls.workdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
     def test_manifest_validation_no_policy(self):
         """Test that manifest validation works when no policy is provided."""
         manifest = {
@@ -427,16 +467,12 @@ class TestManifestPolicyValidation(unittest.TestCase):
 
         defines = {
             "_basedir": "/usr/lib/automotive-image-builder",
-            "_workdir": "/tmp",
+            "_workdir": self.workdir,
         }
 
-        with patch("builtins.open", mock_open_manifest_schema()):
-            loader = ManifestLoader(defines, policy=None)
-            with patch.object(loader, "validator") as mock_validator:
-                mock_validator.iter_errors.return_value = []
-                with patch("yaml.dump"):
-                    # Should not raise any exception
-                    loader._load(manifest, "test.yml", "/tmp")
+        loader = ManifestLoader(defines, policy=None, validator=_NullValidator())
+        # Should not raise any exception
+        loader._load(manifest, "test.yml", "/tmp")
 
     def test_manifest_validation_with_policy_pass(self):
         """Test that manifest validation passes when policy allows the content."""
@@ -459,16 +495,12 @@ class TestManifestPolicyValidation(unittest.TestCase):
 
         defines = {
             "_basedir": "/usr/lib/automotive-image-builder",
-            "_workdir": "/tmp",
+            "_workdir": self.workdir,
         }
 
-        with patch("builtins.open", mock_open_manifest_schema()):
-            loader = ManifestLoader(defines, policy=policy)
-            with patch.object(loader, "validator") as mock_validator:
-                mock_validator.iter_errors.return_value = []
-                with patch("yaml.dump"):
-                    # Should not raise any exception
-                    loader._load(manifest, "test.yml", "/tmp")
+        loader = ManifestLoader(defines, policy=policy, validator=_NullValidator())
+        # Should not raise any exception
+        loader._load(manifest, "test.yml", "/tmp")
 
     def test_manifest_validation_with_policy_fail_property(self):
         """Test that manifest validation fails when policy disallows a property."""
@@ -491,20 +523,14 @@ class TestManifestPolicyValidation(unittest.TestCase):
 
         defines = {
             "_basedir": "/usr/lib/automotive-image-builder",
-            "_workdir": "/tmp",
+            "_workdir": self.workdir,
         }
 
-        with patch("builtins.open", mock_open_manifest_schema()):
-            loader = ManifestLoader(defines, policy=policy)
-            with patch.object(loader, "validator") as mock_validator:
-                mock_validator.iter_errors.return_value = []
-                with patch("yaml.dump"):
-                    # Should raise AIBException due to policy violation
-                    with self.assertRaises(exceptions.AIBException) as ctx:
-                        loader._load(manifest, "test.yml", "/tmp")
-                    self.assertIn(
-                        "forbidden property 'experimental' found", str(ctx.exception)
-                    )
+        loader = ManifestLoader(defines, policy=policy, validator=_NullValidator())
+        # Should raise AIBException due to policy violation
+        with self.assertRaises(exceptions.AIBException) as ctx:
+            loader._load(manifest, "test.yml", "/tmp")
+        self.assertIn("forbidden property 'experimental' found", str(ctx.exception))
 
     def test_manifest_validation_with_policy_fail_value(self):
         """Test that manifest validation fails when policy disallows a value (compliance policy example)."""
@@ -542,63 +568,189 @@ class TestManifestPolicyValidation(unittest.TestCase):
 
         defines = {
             "_basedir": "/usr/lib/automotive-image-builder",
-            "_workdir": "/tmp",
+            "_workdir": self.workdir,
         }
 
-        with patch("builtins.open", mock_open_manifest_schema()):
-            loader = ManifestLoader(defines, policy=policy)
-            with patch.object(loader, "validator") as mock_validator:
-                mock_validator.iter_errors.return_value = []
-                with patch("yaml.dump"):
-                    # Should raise AIBException due to policy violation
-                    with self.assertRaises(exceptions.AIBException) as ctx:
-                        loader._load(manifest, "test.yml", "/tmp")
-                    self.assertIn(
-                        "has forbidden value 'containers-storage'", str(ctx.exception)
-                    )
-
-
-class TestExtendWithDefault(unittest.TestCase):
-    def test_extend_with_default(self):
-        """Test extend_with_default function"""
-        base_validator = jsonschema.Draft7Validator
-        extended_validator = extend_with_default(base_validator)
-
-        # Test that the extended validator has properties validator
-        self.assertIn("properties", extended_validator.VALIDATORS)
-
-        # Test with a schema that has defaults
+        loader = ManifestLoader(defines, policy=policy, validator=_NullValidator())
+        # Should raise AIBException due to policy violation
+        with self.assertRaises(exceptions.AIBException) as ctx:
+            loader._load(manifest, "test.yml", "/tmp")
+        self.assertIn("has forbidden value 'containers-storage'", str(ctx.exception))
+
+
+def test_extend_with_default():
+    """Test extend_with_default function"""
+    extended_validator = extend_with_default(jsonschema.Draft7Validator)
+
+    # Test that the extended validator has properties validator
+    assert "properties" in extended_validator.VALIDATORS
+
+    # Test with a schema that has defaults
+    schema = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "default": "default_name"},
+            "age": {"type": "number"},
+        },
+    }
+
+    instance = {"age": 30}
+    validator = extended_validator(schema)
+
+    # Validate and check if default was set
+    errors = list(validator.iter_errors(instance))
+    assert errors == []
+    assert instance["name"] == "default_name"
+
+
+class TestCompileValidator(unittest.TestCase):
+    schema = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "default": "default_name"},
+            "age": {"type": "number"},
+        },
+    }
+
+    def check_validator(self, validator):
+        instance = {"age": 30}
+        self.assertEqual(list(validator.iter_errors(instance)), [])
+        self.assertEqual(instance["name"], "default_name")
+
+        # Errors are reported as jsonschema errors
+        errors = list(validator.iter_errors({"name": 1, "age": "old"}))
+        self.assertEqual(len(errors), 2)
+        for error in errors:
+            self.assertIsInstance(error, jsonschema.ValidationError)
+
+    def test_compile_validator(self):
+        """Test validation with the validator used by ManifestLoader"""
+        self.check_validator(_compile_validator(json.dumps(self.schema)))
+
+    def test_compile_validator_without_fastjsonschema(self):
+        """Test validation falls back to jsonschema without fastjsonschema"""
+        with patch("aib.simple.fastjsonschema", None):
+            validator = _compile_validator.__wrapped__(json.dumps(self.schema))
+        self.assertNotIsInstance(validator, _FastValidator)
+        self.check_validator(validator)
+
+    @unittest.skipIf(fastjsonschema is None, "fastjsonschema is not installed")
+    def test_default_next_to_ref(self):
+        """Test defaults next to a $ref are used, like for the top-level network"""
         schema = {
+            "$defs": {"network": {"type": "object"}},
             "type": "object",
             "properties": {
-                "name": {"type": "string", "default": "default_name"},
-                "age": {"type": "number"},
+                "network": {"$ref": "#/$defs/network", "default": {"dynamic": {}}}
             },
         }
+        validator = _compile_validator.__wrapped__(json.dumps(schema))
+        self.assertIsInstance(validator, _FastValidator)
+
+        instance = {}
+        self.assertEqual(list(validator.iter_errors(instance)), [])
+        self.assertEqual(instance, {"network": {"dynamic": {}}})
+
+    @unittest.skipIf(fastjsonschema is None, "fastjsonschema is not installed")
+    def test_same_defaults_as_jsonschema(self):
+        """Test both validators fill in the same defaults for all manifests"""
+        project_root = os.path.join(os.path.dirname(__file__), "../..")
+        schema_json = _load_schema_json.__wrapped__(
+            os.path.join(project_root, "files/manifest_schema.yml")
+        )
+        validator = _compile_validator.__wrapped__(schema_json)
+        self.assertIsInstance(validator, _FastValidator)
+        fallback = _DefaultingDraft7Validator(json.loads(schema_json))
 
-        instance = {"age": 30}
-        validator = extended_validator(schema)
+        paths = glob.glob(os.path.join(project_root, "**/*.aib.yml"), recursive=True)
+        self.assertNotEqual(paths, [])
+        for path in paths:
+            with self.subTest(path=path), open(path) as f:
+                manifest = yaml.safe_load(f)
+                expected = copy.deepcopy(manifest)
 
-        # Validate and check if default was set
-        errors = list(validator.iter_errors(instance))
-        self.assertEqual(len(errors), 0)
-        self.assertEqual(instance["name"], "default_name")
+                errors = [e.message for e in validator.iter_errors(manifest)]
+                expected_errors = [e.message for e in fallback.iter_errors(expected)]
+                self.assertEqual(errors, expected_errors)
+                self.assertEqual(manifest, expected)
 
 
 class TestManifestLoader(unittest.TestCase):
-    def load_manifest(self, manifest, policy=None):
+    # The top-level sections are handled independently of each other, so the
+    # test_with_*_section tests share a single manifest that has all of them.
+    sections_manifest = {
+        "name": "test",
+        "version": "1.0",
+        "qm": {
+            "memory_limit": {"max": "1G", "high": "800M"},
+            "cpu_weight": 100,
+            "container_checksum": "sha256:abcd1234",
+            "content": {"rpms": ["qm-package"]},
+        },
+        "network": {
+            "static": {
+                "ip": "192.168.1.100",
+                "ip_prefixlen": 24,
+                "gateway": "192.168.1.1",
+                "dns": ["8.8.8.8"],
+                "iface": "eth0",
+                "load_module": "e1000",
+            }
+        },
+        "auth": {
+            "root_password": "secret",
+            "root_ssh_keys": ["ssh-rsa AAAAB3..."],
+            "sshd_config": {"PermitRootLogin": "yes"},
+            "groups": [{"name": "wheel"}],
+            "users": [{"name": "testuser", "groups": ["wheel"]}],
+        },
+        "kernel": {
+            "kernel_package": "kernel-rt",
+            "kernel_version": "5.14.0",
+            "loglevel": 3,
+            "debug_logging": True,
+            "cmdline": ["quiet", "splash"],
+            "remove_modules": ["pcspkr", "snd_pcsp"],
+        },
+        "image": {
+            "image_size": "10GB",
+            "hostname": "testhost",
+            "ostree_ref": "rhel/9/x86_64/edge",
+            "selinux_mode": "enforcing",
+            "selinux_policy": "targeted",
+            "selinux_booleans": {"httpd_can_network_connect": True},
+            "partitions": {
+                "var": {
+                    "size": "1GB",
+                    "uuid": "12345678-1234-1234-1234-123456789012",
+                },
+                "home": {"size": "2GB"},
+            },
+        },
+        "experimental": {
+            "internal_defines": {"custom_var": "custom_value", "another_var": 42}
+        },
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.sections_defines = cls.load_manifest(cls.sections_manifest).defines
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    @classmethod
+    def load_manifest(cls, manifest, policy=None):
         defines = {
             "_basedir": "/usr/lib/automotive-image-builder",
-            "_workdir": "/tmp",
+            "_workdir": cls.workdir,
             "arch": "x86_64",
         }
 
-        with patch("builtins.open", mock_open_manifest_schema()):
-            loader = ManifestLoader(defines, policy)
-            with patch.object(loader, "validator") as mock_validator:
-                mock_validator.iter_errors.return_value = []
-                with patch("yaml.dump"):
-                    loader._load(manifest, "test.yml", "/tmp")
+        loader = ManifestLoader(defines, policy, validator=_NullValidator())
+        loader._load(manifest, "test.yml", "/tmp")
         return loader
 
     def test_basic(self):
@@ -624,137 +776,62 @@ class TestManifestLoader(unittest.TestCase):
         self.assertEqual(loader.defines["version"], "1.0")
 
     def test_with_qm_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "qm": {
-                "memory_limit": {"max": "1G", "high": "800M"},
-                "cpu_weight": 100,
-                "container_checksum": "sha256:abcd1234",
-                "content": {"rpms": ["qm-package"]},
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["use_qm"], True)
-        self.assertEqual(loader.defines["qm_memory_max"], "1G")
-        self.assertEqual(loader.defines["qm_memory_high"], "800M")
-        self.assertEqual(loader.defines["qm_cpu_weight"], 100)
-        self.assertEqual(loader.defines["boot_check_qm_digest"], "sha256:abcd1234")
+        defines = self.sections_defines
+        self.assertEqual(defines["use_qm"], True)
+        self.assertEqual(defines["qm_memory_max"], "1G")
+        self.assertEqual(defines["qm_memory_high"], "800M")
+        self.assertEqual(defines["qm_cpu_weight"], 100)
+        self.assertEqual(defines["boot_check_qm_digest"], "sha256:abcd1234")
 
     def test_with_network_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "network": {
-                "static": {
-                    "ip": "192.168.1.100",
-                    "ip_prefixlen": 24,
-                    "gateway": "192.168.1.1",
-                    "dns": ["8.8.8.8"],
-                    "iface": "eth0",
-                    "load_module": "e1000",
-                }
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["use_static_ip"], True)
-        self.assertEqual(loader.defines["static_ip"], "192.168.1.100")
-        self.assertEqual(loader.defines["static_ip_prefixlen"], "24")
-        self.assertEqual(loader.defines["static_gw"], "192.168.1.1")
-        self.assertEqual(loader.defines["static_dns"], ["8.8.8.8"])
-        self.assertEqual(loader.defines["static_ip_iface"], "eth0")
-        self.assertEqual(loader.defines["static_ip_modules"], ["e1000"])
+        defines = self.sections_defines
+        self.assertEqual(defines["use_static_ip"], True)
+        self.assertEqual(defines["static_ip"], "192.168.1.100")
+        self.assertEqual(defines["static_ip_prefixlen"], "24")
+        self.assertEqual(defines["static_gw"], "192.168.1.1")
+        self.assertEqual(defines["static_dns"], ["8.8.8.8"])
+        self.assertEqual(defines["static_ip_iface"], "eth0")
+        self.assertEqual(defines["static_ip_modules"], ["e1000"])
 
     def test_with_auth_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "auth": {
-                "root_password": "secret",
-                "root_ssh_keys": ["ssh-rsa AAAAB3..."],
-                "sshd_config": {"PermitRootLogin": "yes"},
-                "groups": [{"name": "wheel"}],
-                "users": [{"name": "testuser", "groups": ["wheel"]}],
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["root_password"], "secret")
-        self.assertEqual(loader.defines["root_ssh_keys"], ["ssh-rsa AAAAB3..."])
-        self.assertEqual(
-            loader.defines["simple_sshd_config"], {"PermitRootLogin": "yes"}
-        )
-        self.assertEqual(loader.defines["simple_groups"], [{"name": "wheel"}])
+        defines = self.sections_defines
+        self.assertEqual(defines["root_password"], "secret")
+        self.assertEqual(defines["root_ssh_keys"], ["ssh-rsa AAAAB3..."])
+        self.assertEqual(defines["simple_sshd_config"], {"PermitRootLogin": "yes"})
+        self.assertEqual(defines["simple_groups"], [{"name": "wheel"}])
         self.assertEqual(
-            loader.defines["simple_users"], [{"name": "testuser", "groups": ["wheel"]}]
+            defines["simple_users"], [{"name": "testuser", "groups": ["wheel"]}]
         )
 
     def test_with_kernel_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "kernel": {
-                "kernel_package": "kernel-rt",
-                "kernel_version": "5.14.0",
-                "loglevel": 3,
-                "debug_logging": True,
-                "cmdline": ["quiet", "splash"],
-                "remove_modules": ["pcspkr", "snd_pcsp"],
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["kernel_package"], "kernel-rt")
-        self.assertEqual(loader.defines["kernel_version"], "5.14.0")
-        self.assertEqual(loader.defines["kernel_loglevel"], 3)
-        self.assertEqual(loader.defines["use_debug"], True)
-        self.assertEqual(loader.defines["simple_kernel_opts"], ["quiet", "splash"])
-        self.assertEqual(loader.defines["denylist_modules"], ["pcspkr", "snd_pcsp"])
+        defines = self.sections_defines
+        self.assertEqual(defines["kernel_package"], "kernel-rt")
+        self.assertEqual(defines["kernel_version"], "5.14.0")
+        self.assertEqual(defines["kernel_loglevel"], 3)
+        self.assertEqual(defines["use_debug"], True)
+        self.assertEqual(defines["simple_kernel_opts"], ["quiet", "splash"])
+        self.assertEqual(defines["denylist_modules"], ["pcspkr", "snd_pcsp"])
 
     def test_with_image_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "image": {
-                "image_size": "10GB",
-                "hostname": "testhost",
-                "ostree_ref": "rhel/9/x86_64/edge",
-                "selinux_mode": "enforcing",
-                "selinux_policy": "targeted",
-                "selinux_booleans": {"httpd_can_network_connect": True},
-                "partitions": {
-                    "var": {
-                        "size": "1GB",
-                        "uuid": "12345678-1234-1234-1234-123456789012",
-                    },
-                    "home": {"size": "2GB"},
-                },
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["image_size"], str(10 * 1000 * 1000 * 1000))
-        self.assertEqual(loader.defines["hostname"], "testhost")
-        self.assertEqual(loader.defines["ostree_ref"], "rhel/9/x86_64/edge")
-        self.assertEqual(loader.defines["selinux_mode"], "enforcing")
-        self.assertEqual(loader.defines["selinux_policy"], "targeted")
+        defines = self.sections_defines
+        self.assertEqual(defines["image_size"], str(10 * 1000 * 1000 * 1000))
+        self.assertEqual(defines["hostname"], "testhost")
+        self.assertEqual(defines["ostree_ref"], "rhel/9/x86_64/edge")
+        self.assertEqual(defines["selinux_mode"], "enforcing")
+        self.assertEqual(defines["selinux_policy"], "targeted")
         self.assertEqual(
-            loader.defines["selinux_booleans"], ["httpd_can_network_connect=true"]
+            defines["selinux_booleans"], ["httpd_can_network_connect=true"]
         )
-        self.assertEqual(loader.defines["varpart_size"], int(1000 * 1000 * 1000 / 512))
+        self.assertEqual(defines["varpart_size"], int(1000 * 1000 * 1000 / 512))
         self.assertEqual(
-            loader.defines["varpart_uuid"], "12345678-1234-1234-1234-123456789012"
+            defines["varpart_uuid"], "12345678-1234-1234-1234-123456789012"
         )
-        self.assertEqual(loader.defines["homepart_size"], int(2000 * 1000 * 1000 / 512))
+        self.assertEqual(defines["homepart_size"], int(2000 * 1000 * 1000 / 512))
 
     def test_with_experimental_section(self):
-        manifest = {
-            "name": "test",
-            "version": "1.0",
-            "experimental": {
-                "internal_defines": {"custom_var": "custom_value", "another_var": 42}
-            },
-        }
-        loader = self.load_manifest(manifest)
-        self.assertEqual(loader.defines["custom_var"], "custom_value")
-        self.assertEqual(loader.defines["another_var"], 42)
+        defines = self.sections_defines
+        self.assertEqual(defines["custom_var"], "custom_value")
+        self.assertEqual(defines["another_var"], 42)
 
     def test_default_expand(self):
         manifest = {
@@ -815,6 +892,35 @@ class TestManifestLoader(unittest.TestCase):
         loader = self.load_manifest(manifest)
         self.assertEqual(loader.defines["varpart_relative_size"], -0.5)
 
+    def clear_validator_caches(self):
+        """Start with empty schema and validator caches, and leave them empty"""
+        for cached in (_load_schema_json, _compile_validator):
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+
+    def test_validator_shared(self):
+        """Test that loaders with the same schema share one validator"""
+        self.clear_validator_caches()
+        defines = {"_basedir": "/test", "_workdir": "/tmp"}
+
+        with patch("builtins.open", mock_open_manifest_schema()):
+            loader1 = ManifestLoader(dict(defines))
+            loader2 = ManifestLoader(dict(defines))
+
+        self.assertIs(loader1.validator, loader2.validator)
+
+    def test_schema_read_once(self):
+        """Test that the schema file is only read for the first loader"""
+        self.clear_validator_caches()
+        defines = {"_basedir": "/test", "_workdir": "/tmp"}
+
+        mock_open = Mock(side_effect=mock_open_manifest_schema())
+        with patch("builtins.open", mock_open):
+            ManifestLoader(dict(defines))
+            ManifestLoader(dict(defines))
+
+        mock_open.assert_called_once()
+
     def test_set_method(self):
         """Test the set method behavior with empty values"""
         defines = {
@@ -866,9 +972,21 @@ class TestManifestLoader(unittest.TestCase):
         self.assertNotIn("dest_key3", loader.defines)
 
 
-def mock_open_manifest_schema():
-    """Mock the manifest schema file"""
-    schema_content = {
+class _NullValidator:
+    """Validator that accepts every manifest"""
+
+    def iter_errors(self, instance):
+        return iter(())
+
+
+def _fake_open(data):
+    """Replacement for open() that returns a new StringIO with data on each call"""
+    return lambda *args, **kwargs: io.StringIO(data)
+
+
+# Dumped once at import, every mock_open_manifest_schema() call reuses it
+_MANIFEST_SCHEMA_YAML = yaml.dump(
+    {
         "type": "object",
         "properties": {
             "name": {"type": "string"},
@@ -882,69 +1000,82 @@ def mock_open_manifest_schema():
             "experimental": {"type": "object"},
         },
     }
-    return mock_open(read_data=yaml.dump(schema_content))
+)
+
+
+def mock_open_manifest_schema():
+    """Mock the manifest schema file"""
+    return _fake_open(_MANIFEST_SCHEMA_YAML)
+
+
+class _MockContents:
+    """Stand-in for Contents with just the lists that ExtraInclude fills in"""
+
+    __slots__ = ("file_content_copy", "make_dirs")
+
+    def __init__(self):
+        self.file_content_copy = []
+        self.make_dirs = []
+
+
+def _create_glob_test_tree(test_dir):
+    """Create the directory structure used by the glob tests.
+
+    test_dir/
+      ├── files/
+      │   ├── config1.conf
+      │   ├── config2.conf
+      │   └── readme.txt
+      ├── subdir1/
+      │   ├── app.log
+      │   └── data.py
+      └── subdir2/
+          ├── system.log
+          └── utils.py
+    """
+    for subdir in ("files", "subdir1", "subdir2"):
+        os.makedirs(os.path.join(test_dir, subdir))
+
+    test_files = {
+        "files/config1.conf": "# Configuration 1\nkey1=value1\n",
+        "files/config2.conf": "# Configuration 2\nkey2=value2\n",
+        "files/readme.txt": "This is a readme file\n",
+        "subdir1/app.log": "Application log entry\n",
+        "subdir1/data.py": "# Python data module\ndata = [1, 2, 3]\n",
+        "subdir2/system.log": "System log entry\n",
+        "subdir2/utils.py": "# Python utilities\ndef helper(): pass\n",
+    }
+
+    for rel_path, content in test_files.items():
+        full_path = os.path.join(test_dir, rel_path)
+        with open(full_path, "w") as f:
+            f.write(content)
 
 
 class TestExtraIncludeGlob(unittest.TestCase):
-    """Test the new glob functionality in ExtraInclude class."""
+    """Test the new glob functionality in ExtraInclude class.
 
-    def setUp(self):
-        """Create a temporary directory structure for testing."""
-        self.test_dir = tempfile.mkdtemp()
-        self.addCleanup(self._cleanup_test_dir)
-
-        # Create test directory structure
-        # test_dir/
-        #   ├── files/
-        #   │   ├── config1.conf
-        #   │   ├── config2.conf
-        #   │   └── readme.txt
-        #   ├── subdir1/
-        #   │   ├── app.log
-        #   │   └── data.py
-        #   └── subdir2/
-        #       ├── system.log
-        #       └── utils.py
-
-        self.files_dir = os.path.join(self.test_dir, "files")
-        self.subdir1 = os.path.join(self.test_dir, "subdir1")
-        self.subdir2 = os.path.join(self.test_dir, "subdir2")
-
-        os.makedirs(self.files_dir)
-        os.makedirs(self.subdir1)
-        os.makedirs(self.subdir2)
-
-        # Create test files
-        test_files = {
-            "files/config1.conf": "# Configuration 1\nkey1=value1\n",
-            "files/config2.conf": "# Configuration 2\nkey2=value2\n",
-            "files/readme.txt": "This is a readme file\n",
-            "subdir1/app.log": "Application log entry\n",
-            "subdir1/data.py": "# Python data module\ndata = [1, 2, 3]\n",
-            "subdir2/system.log": "System log entry\n",
-            "subdir2/utils.py": "# Python utilities\ndef helper(): pass\n",
-        }
+    The directory tree is shared by all tests in this class and must not be
+    modified, tests that need to add files go in TestExtraIncludeGlobMutating.
+    """
 
-        for rel_path, content in test_files.items():
-            full_path = os.path.join(self.test_dir, rel_path)
-            with open(full_path, "w") as f:
-                f.write(content)
+    @classmethod
+    def setUpClass(cls):
+        """Create a temporary directory structure for testing."""
+        cls.test_dir = tempfile.mkdtemp()
+        _create_glob_test_tree(cls.test_dir)
 
-    def _cleanup_test_dir(self):
+    @classmethod
+    def tearDownClass(cls):
         """Clean up the temporary test directory."""
-        shutil.rmtree(self.test_dir, ignore_errors=True)
+        shutil.rmtree(cls.test_dir, ignore_errors=True)
 
     def test_glob_files_flatten(self):
         """Test glob file copying with flattened structure."""
         extra_include = ExtraInclude(self.test_dir)
 
         # Mock contents object
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test flattening .conf files
         data = {
@@ -964,7 +1095,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///etc/config/config1.conf",
             "tree:///etc/config/config2.conf",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
         # Verify file_content_inputs were created
         self.assertEqual(len(extra_include.file_content_inputs), 2)
@@ -973,12 +1104,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test glob file copying with path preservation."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test preserving paths for .py files with recursive glob pattern
         data = {"source_glob": "**/*.py", "path": "/app/python", "preserve_path": True}
@@ -994,18 +1120,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///app/python/subdir1/data.py",
             "tree:///app/python/subdir2/utils.py",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_glob_files_preserve_path_recursive_working(self):
         """Test glob file copying with path preservation using explicit subdirectory patterns."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test preserving paths using wildcard subdir pattern
         data = {
@@ -1025,18 +1146,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///app/python/subdir1/data.py",
             "tree:///app/python/subdir2/utils.py",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_glob_files_preserve_path_real_directory(self):
         """Test glob file copying with path preservation from a real directory path."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test preserving paths with a real directory (no wildcards in directory part)
         data = {
@@ -1056,18 +1172,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///etc/config/files/config1.conf",
             "tree:///etc/config/files/config2.conf",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_glob_files_preserve_path_with_subdirectory(self):
         """Test glob file copying with path preservation from a subdirectory."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test preserving paths when globbing from a specific subdirectory
         data = {"source_glob": "subdir1/*", "path": "/app/logs", "preserve_path": True}
@@ -1083,17 +1194,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///app/logs/subdir1/app.log",
             "tree:///app/logs/subdir1/data.py",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_glob_files_no_matches_error(self):
         """Test that an error is raised when no files match the glob pattern."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test with a pattern that matches no files
         data = {
@@ -1108,45 +1215,29 @@ class TestExtraIncludeGlob(unittest.TestCase):
         self.assertIn("No files matched glob pattern", str(context.exception))
         self.assertEqual(context.exception.glob_pattern, "nonexistent/*.xyz")
 
-    def test_glob_files_max_files_limit(self):
-        """Test that glob pattern raises TooManyFilesError when max_files limit is exceeded."""
+    def test_glob_files_literal_path(self):
+        """Test that a source_glob without wildcards matches just that file."""
         extra_include = ExtraInclude(self.test_dir)
+        contents = _MockContents()
 
-        # Create more files than the limit
-        for i in range(5):
-            with open(os.path.join(self.test_dir, f"test_file_{i}.txt"), "w") as f:
-                f.write(f"content {i}")
-
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-
-        contents = MockContents()
-
-        data = {"source_glob": "test_file_*.txt", "path": "/tmp/test", "max_files": 3}
-
-        # Should raise TooManyFilesError
-        with self.assertRaises(exceptions.TooManyFilesError) as cm:
-            extra_include._add_glob_files(contents, data)
+        data = {"source_glob": "files/readme.txt", "path": "/etc/docs"}
+        extra_include._add_glob_files(contents, data)
 
-        # Check the error message contains expected information
-        error_message = str(cm.exception)
-        self.assertIn("matched 5 files", error_message)
-        self.assertIn("max_files limit is 3", error_message)
-        self.assertIn("test_file_*.txt", error_message)
+        dest_paths = [entry["to"] for entry in contents.file_content_copy]
+        self.assertEqual(dest_paths, ["tree:///etc/docs/readme.txt"])
 
-        # Should not process any files due to error
-        self.assertEqual(len(contents.file_content_copy), 0)
+        # A literal path that is not a file still counts as no match
+        for missing in ["files/missing.txt", "files"]:
+            with self.assertRaises(exceptions.NoMatchingFilesError):
+                extra_include._add_glob_files(
+                    contents, {"source_glob": missing, "path": "/etc/docs"}
+                )
 
     def test_glob_files_default_preserve_path(self):
         """Test that preserve_path defaults to False when not specified."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test without preserve_path specified (should default to False)
         data = {
@@ -1163,18 +1254,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///etc/config/config1.conf",
             "tree:///etc/config/config2.conf",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_glob_files_absolute_path(self):
         """Test glob functionality with absolute paths."""
         extra_include = ExtraInclude("/some/other/dir")  # Different basedir
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test with absolute glob pattern
         absolute_glob = os.path.join(self.test_dir, "files", "*.conf")
@@ -1193,18 +1279,13 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///etc/config/config1.conf",
             "tree:///etc/config/config2.conf",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
     def test_add_file_copy_integration(self):
         """Test that add_file_copy properly delegates to _add_glob_files."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test that add_file_copy calls _add_glob_files for glob patterns
         data = {
@@ -1233,12 +1314,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test that directories are added to make_dirs when preserve_path=True creates subdirectories."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test with preserve_path=True that creates subdirectories
         data = {"source_glob": "**/*.py", "path": "/app/python", "preserve_path": True}
@@ -1250,7 +1326,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         # Check that the correct directories were added
         created_dirs = [d["path"] for d in contents.make_dirs]
         expected_dirs = ["/app/python/subdir1", "/app/python/subdir2"]
-        self.assertEqual(sorted(created_dirs), sorted(expected_dirs))
+        self.assertCountEqual(created_dirs, expected_dirs)
 
         # All make_dirs entries should have parents=True
         for dir_entry in contents.make_dirs:
@@ -1267,12 +1343,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test that no directories are added to make_dirs when preserve_path=False (flattened)."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test with preserve_path=False (flattened)
         data = {
@@ -1301,12 +1372,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test that duplicate directories are not added to make_dirs."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Add files to same subdirectory twice
         data1 = {"source_glob": "subdir1/*.py", "path": "/app", "preserve_path": True}
@@ -1319,57 +1385,33 @@ class TestExtraIncludeGlob(unittest.TestCase):
         self.assertEqual(len(contents.make_dirs), 1)
         self.assertEqual(contents.make_dirs[0]["path"], "/app/subdir1")
 
-    def test_glob_files_with_parent_dir_references(self):
-        """Test glob patterns that use ../ and could generate invalid paths."""
-        # Create a basedir that simulates the examples directory
-        examples_dir = os.path.join(self.test_dir, "examples")
-        os.makedirs(examples_dir)
-
-        # Create some test files in sibling directory to examples
-        aib_dir = os.path.join(self.test_dir, "aib")
-        os.makedirs(aib_dir)
-        with open(os.path.join(aib_dir, "test_file.py"), "w") as f:
-            f.write("# test file")
-
-        extra_include = ExtraInclude(examples_dir)
-
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+    def test_glob_files_escaping_glob_base(self):
+        """Test that files outside the glob base fall back to their basename."""
+        extra_include = ExtraInclude(self.test_dir)
+        contents = _MockContents()
 
-        # Test glob pattern that goes up a directory level (like in glob-files.aib.yml)
+        # The glob base is 'subdir', but the matches are in 'files'
         data = {
-            "source_glob": "../aib/*.py",
-            "path": "/etc/app/aib",
+            "source_glob": "subdir*/../files/*.conf",
+            "path": "/etc/app",
             "preserve_path": True,
         }
 
         extra_include._add_glob_files(contents, data)
 
-        # Should have processed the file
-        self.assertEqual(len(contents.file_content_copy), 1)
-
-        # The destination path should not contain "../" sequences
-        dest_path = contents.file_content_copy[0]["to"]
-        self.assertNotIn("..", dest_path)
-
-        # Since the relative path contains "..", it should fall back to basename
-        expected_path = "tree:///etc/app/aib/test_file.py"
-        self.assertEqual(dest_path, expected_path)
+        dest_paths = {entry["to"] for entry in contents.file_content_copy}
+        expected_paths = {
+            "tree:///etc/app/config1.conf",
+            "tree:///etc/app/config2.conf",
+        }
+        self.assertEqual(dest_paths, expected_paths)
+        self.assertEqual(contents.make_dirs, [])
 
     def test_glob_files_recursive_directory_contents(self):
         """Test glob patterns with /**/* that copy directory contents without the directory itself."""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test pattern that should copy contents of subdir1 without the subdir1 directory itself
         data = {
@@ -1389,63 +1431,16 @@ class TestExtraIncludeGlob(unittest.TestCase):
             "tree:///app/extracted/app.log",
             "tree:///app/extracted/data.py",
         ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
+        self.assertCountEqual(dest_paths, expected_paths)
 
         # No directories should be created since files go directly to the destination
         self.assertEqual(len(contents.make_dirs), 0)
 
-    def test_glob_files_recursive_with_subdirs(self):
-        """Test glob patterns with /**/* that include subdirectories."""
-        extra_include = ExtraInclude(self.test_dir)
-
-        # Create additional nested structure
-        nested_dir = os.path.join(self.test_dir, "subdir1", "nested")
-        os.makedirs(nested_dir)
-        with open(os.path.join(nested_dir, "deep.txt"), "w") as f:
-            f.write("deep file")
-
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
-
-        # Test pattern that should copy all contents recursively
-        data = {
-            "source_glob": "subdir1/**/*",
-            "path": "/app/extracted",
-            "preserve_path": True,
-        }
-
-        extra_include._add_glob_files(contents, data)
-
-        # Should have processed all files including nested ones
-        self.assertEqual(len(contents.file_content_copy), 3)
-
-        # Check that nested structure is preserved but subdir1 prefix is stripped
-        dest_paths = [entry["to"] for entry in contents.file_content_copy]
-        expected_paths = [
-            "tree:///app/extracted/app.log",
-            "tree:///app/extracted/data.py",
-            "tree:///app/extracted/nested/deep.txt",
-        ]
-        self.assertEqual(sorted(dest_paths), sorted(expected_paths))
-
-        # Should create the nested directory
-        self.assertEqual(len(contents.make_dirs), 1)
-        self.assertEqual(contents.make_dirs[0]["path"], "/app/extracted/nested")
-
     def test_glob_files_allow_empty_true(self):
         """Test that allow_empty=True creates destination directory when no files match"""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test pattern that matches nothing
         data = {
@@ -1469,12 +1464,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test that allow_empty=False (default) raises NoMatchingFilesError when no files match"""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test pattern that matches nothing with default allow_empty=False
         data = {
@@ -1496,12 +1486,7 @@ class TestExtraIncludeGlob(unittest.TestCase):
         """Test that explicitly setting allow_empty=False raises exception when no files match"""
         extra_include = ExtraInclude(self.test_dir)
 
-        class MockContents:
-            def __init__(self):
-                self.file_content_copy = []
-                self.make_dirs = []
-
-        contents = MockContents()
+        contents = _MockContents()
 
         # Test pattern that matches nothing with explicit allow_empty=False
         data = {
@@ -1515,3 +1500,137 @@ class TestExtraIncludeGlob(unittest.TestCase):
             extra_include._add_glob_files(contents, data)
 
         self.assertIn("missing/*.txt", str(cm.exception))
+
+
+class TestExtraIncludeGlobMutating(unittest.TestCase):
+    """Glob tests that add files to the test directory tree."""
+
+    def setUp(self):
+        """Create a temporary directory structure for testing."""
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir, ignore_errors=True)
+        _create_glob_test_tree(self.test_dir)
+
+    def test_glob_files_max_files_limit(self):
+        """Test that glob pattern raises TooManyFilesError when max_files limit is exceeded."""
+        extra_include = ExtraInclude(self.test_dir)
+
+        # Create more files than the limit
+        for i in range(5):
+            with open(os.path.join(self.test_dir, f"test_file_{i}.txt"), "w") as f:
+                f.write(f"content {i}")
+
+        contents = _MockContents()
+
+        data = {"source_glob": "test_file_*.txt", "path": "/tmp/test", "max_files": 3}
+
+        # Should raise TooManyFilesError
+        with self.assertRaises(exceptions.TooManyFilesError) as cm:
+            extra_include._add_glob_files(contents, data)
+
+        # Check the error message contains expected information
+        error_message = str(cm.exception)
+        self.assertIn("matched 5 files", error_message)
+        self.assertIn("max_files limit is 3", error_message)
+        self.assertIn("test_file_*.txt", error_message)
+
+        # Should not process any files due to error
+        self.assertEqual(len(contents.file_content_copy), 0)
+
+    def test_glob_files_with_parent_dir_references(self):
+        """Test glob patterns that use ../ and could generate invalid paths."""
+        # Create a basedir that simulates the examples directory
+        examples_dir = os.path.join(self.test_dir, "examples")
+        os.makedirs(examples_dir)
+
+        # Create some test files in sibling directory to examples
+        aib_dir = os.path.join(self.test_dir, "aib")
+        os.makedirs(aib_dir)
+        with open(os.path.join(aib_dir, "test_file.py"), "w") as f:
+            f.write("# test file")
+
+        extra_include = ExtraInclude(examples_dir)
+
+        contents = _MockContents()
+
+        # Test glob pattern that goes up a directory level (like in glob-files.aib.yml)
+        data = {
+            "source_glob": "../aib/*.py",
+            "path": "/etc/app/aib",
+            "preserve_path": True,
+        }
+
+        extra_include._add_glob_files(contents, data)
+
+        # Should have processed the file
+        self.assertEqual(len(contents.file_content_copy), 1)
+
+        # The destination path should not contain "../" sequences
+        dest_path = contents.file_content_copy[0]["to"]
+        self.assertNotIn("..", dest_path)
+
+        # Since the relative path contains "..", it should fall back to basename
+        expected_path = "tree:///etc/app/aib/test_file.py"
+        self.assertEqual(dest_path, expected_path)
+
+    def test_glob_files_recursive_with_subdirs(self):
+        """Test glob patterns with /**/* that include subdirectories."""
+        extra_include = ExtraInclude(self.test_dir)
+
+        # Create additional nested structure
+        nested_dir = os.path.join(self.test_dir, "subdir1", "nested")
+        os.makedirs(nested_dir)
+        with open(os.path.join(nested_dir, "deep.txt"), "w") as f:
+            f.write("deep file")
+
+        contents = _MockContents()
+
+        # Test pattern that should copy all contents recursively
+        data = {
+            "source_glob": "subdir1/**/*",
+            "path": "/app/extracted",
+            "preserve_path": True,
+        }
+
+        extra_include._add_glob_files(contents, data)
+
+        # Should have processed all files including nested ones
+        self.assertEqual(len(contents.file_content_copy), 3)
+
+        # Check that nested structure is preserved but subdir1 prefix is stripped
+        dest_paths = [entry["to"] for entry in contents.file_content_copy]
+        expected_paths = [
+            "tree:///app/extracted/app.log",
+            "tree:///app/extracted/data.py",
+            "tree:///app/extracted/nested/deep.txt",
+        ]
+        self.assertCountEqual(dest_paths, expected_paths)
+
+        # Should create the nested directory
+        self.assertEqual(len(contents.make_dirs), 1)
+        self.assertEqual(contents.make_dirs[0]["path"], "/app/extracted/nested")
+
+    def test_glob_files_recursive_skips_hidden(self):
+        """Test that recursive globs skip hidden files and directories like glob does."""
+        extra_include = ExtraInclude(self.test_dir)
+
+        hidden_dir = os.path.join(self.test_dir, "subdir1", ".hidden")
+        os.makedirs(hidden_dir)
+        for path in [
+            os.path.join(hidden_dir, "secret.py"),
+            os.path.join(self.test_dir, "subdir1", ".dotfile.py"),
+        ]:
+            with open(path, "w") as f:
+                f.write("hidden")
+
+        contents = _MockContents()
+
+        data = {"source_glob": "**/*.py", "path": "/app/python", "preserve_path": True}
+        extra_include._add_glob_files(contents, data)
+
+        dest_paths = [entry["to"] for entry in contents.file_content_copy]
+        expected_paths = [
+            "tree:///app/python/subdir1/data.py",
+            "tree:///app/python/subdir2/utils.py",
+        ]
+        self.assertCountEqual(dest_paths, expected_paths)
@@ -1,11 +1,25 @@
+import base64
+import errno
 import os
+import shutil
+import struct
+import subprocess
 import tempfile
 import unittest
+from contextlib import ExitStack
 from io import StringIO
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from aib import utils
 
+# Looked up once, used to validate convert_to_simg output when available
+SIMG2IMG = shutil.which("simg2img")
+OPENSSL = shutil.which("openssl")
+
+# Android sparse image file and chunk headers
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+CHUNK_HEADER = struct.Struct("<HHII")
+
 
 class TestExtractCommentsHeader(unittest.TestCase):
     def test_extract_comment_header(self):
@@ -174,18 +188,132 @@ class TestRoundup(unittest.TestCase):
             utils.roundup(100, 0)
 
 
+class TestCreateCpioArchive(unittest.TestCase):
+    """Tests for create_cpio_archive function."""
+
+    def test_unknown_compression(self):
+        """Unknown compression fails without creating dest."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest = os.path.join(tmpdir, "initrd.append")
+            with self.assertRaises(RuntimeError):
+                utils.create_cpio_archive(dest, tmpdir, ["a"], "nosuchkind")
+            self.assertFalse(os.path.exists(dest))
+
+    def test_failed_pipeline_removes_dest(self):
+        """A pipeline that fails to run leaves no partial dest behind."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest = os.path.join(tmpdir, "initrd.append")
+            with patch.object(
+                utils, "initrd_compressor_for", return_value=["/nonexistent/gzip"]
+            ):
+                with self.assertRaises(RuntimeError):
+                    utils.create_cpio_archive(dest, tmpdir, ["a"], "gzip")
+            self.assertFalse(os.path.exists(dest))
+
+
+@unittest.skipUnless(OPENSSL, "openssl not available")
+class TestReadKeys(unittest.TestCase):
+    """Tests for read_keys function."""
+
+    def test_read_keys(self):
+        """Keys match the DER encoded parts of the PEM key."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keypath = os.path.join(tmpdir, "key")
+            subprocess.run(
+                ["openssl", "genpkey", "-algorithm", "ed25519", "-out", keypath],
+                check=True,
+            )
+            pubkey, seckey = utils.read_keys(keypath)
+
+            pub_der = utils.openssl_stdout(
+                "pkey", "-outform", "DER", "-pubout", "-in", keypath
+            )
+            priv_der = utils.openssl_stdout("pkey", "-outform", "DER", "-in", keypath)
+
+        self.assertEqual(base64.b64decode(pubkey), pub_der[-32:])
+        self.assertEqual(base64.b64decode(seckey), priv_der[-32:] + pub_der[-32:])
+
+    def test_read_keys_invalid(self):
+        """Non-ed25519 keys are rejected."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keypath = os.path.join(tmpdir, "key")
+            subprocess.run(
+                ["openssl", "genpkey", "-algorithm", "EC", "-out", keypath]
+                + ["-pkeyopt", "ec_paramgen_curve:P-256"],
+                check=True,
+            )
+            with self.assertRaises(RuntimeError):
+                utils.read_keys(keypath)
+
+
+class TestSudoTemporaryDirectory(unittest.TestCase):
+    """Tests for SudoTemporaryDirectory class."""
+
+    @unittest.skipIf(os.geteuid() == 0, "permissions are not enforced for root")
+    def test_cleanup_read_only(self):
+        """Read-only and unreadable directories are removed without sudo."""
+        with tempfile.TemporaryDirectory() as base:
+            with utils.SudoTemporaryDirectory(
+                dir=base, use_sudo_fallback=False
+            ) as tmpdir:
+                for d in ["ro/sub", "noread"]:
+                    os.makedirs(os.path.join(tmpdir.name, d))
+                for f in ["ro/a", "ro/sub/b", "noread/c"]:
+                    with open(os.path.join(tmpdir.name, f), "w") as fh:
+                        fh.write("x")
+                for d, mode in [("ro/sub", 0o500), ("ro", 0o500), ("noread", 0)]:
+                    os.chmod(os.path.join(tmpdir.name, d), mode)
+                os.chmod(tmpdir.name, 0o500)
+
+            self.assertFalse(os.path.exists(tmpdir.name))
+            self.assertEqual(os.listdir(base), [])
+
+    def _check_sudo_fallback(self, error):
+        """Cleanup failing with error falls back to sudo rm."""
+        with tempfile.TemporaryDirectory() as base:
+            tmpdir = utils.SudoTemporaryDirectory(dir=base)
+            os.makedirs(os.path.join(tmpdir.name, "sub"))
+            with open(os.path.join(tmpdir.name, "sub", "file"), "w") as fh:
+                fh.write("x")
+
+            with patch("os.scandir", side_effect=error), patch.object(
+                utils.subprocess, "run"
+            ) as mock_run:
+                tmpdir.cleanup()
+
+            mock_run.assert_called_once()
+            self.assertEqual(
+                mock_run.call_args.args[0], ["sudo", "rm", "-rf", "--", tmpdir.name]
+            )
+
+    def test_cleanup_io_error(self):
+        """Non-permission errors are not retried."""
+        self._check_sudo_fallback(OSError(errno.EIO, "I/O error"))
+
+    def test_cleanup_permission_error(self):
+        """Permission errors that persist are only retried once."""
+        self._check_sudo_fallback(PermissionError(errno.EACCES, "Permission denied"))
+
+
 class TestExtractPartOfFile(unittest.TestCase):
     """Tests for extract_part_of_file function."""
 
-    def setUp(self):
-        """Set up temporary directory for tests."""
-        self.test_dir = tempfile.mkdtemp()
+    @classmethod
+    def setUpClass(cls):
+        """Set up temporary directory for tests, in memory if possible."""
+        shm = "/dev/shm"
+        cls.class_dir = tempfile.mkdtemp(dir=shm if os.path.isdir(shm) else None)
 
-    def tearDown(self):
+    @classmethod
+    def tearDownClass(cls):
         """Clean up temporary directory."""
-        import shutil
+        shutil.rmtree(cls.class_dir, ignore_errors=True)
 
-        shutil.rmtree(self.test_dir, ignore_errors=True)
+    def setUp(self):
+        """Give each test its own directory."""
+        self.test_dir = os.path.join(self.class_dir, self._testMethodName)
+        os.mkdir(self.test_dir)
+        self.addCleanup(shutil.rmtree, self.test_dir, ignore_errors=True)
 
     def test_basic_extraction(self):
         """Test basic file extraction."""
@@ -232,6 +360,37 @@ class TestExtractPartOfFile(unittest.TestCase):
         with open(dst, "rb") as f:
             self.assertEqual(f.read(), data)
 
+    def _check_extract_fallback(self, *unsupported):
+        src = os.path.join(self.test_dir, "source.bin")
+        dst = os.path.join(self.test_dir, "dest.bin")
+
+        data = bytes(range(256)) * 4
+        with open(src, "wb") as f:
+            f.write(data)
+
+        with ExitStack() as stack:
+            for name in unsupported:
+                stack.enter_context(
+                    patch(
+                        "aib.utils.os." + name,
+                        side_effect=OSError(errno.EXDEV, "Invalid cross-device link"),
+                        create=True,
+                    )
+                )
+            written = utils.extract_part_of_file(src, dst, 100, 800, chunk_size=64)
+
+        self.assertEqual(written, 800)
+        with open(dst, "rb") as f:
+            self.assertEqual(f.read(), data[100:900])
+
+    def test_extract_without_copy_file_range(self):
+        """Test extraction falls back to sendfile if copy_file_range fails."""
+        self._check_extract_fallback("copy_file_range")
+
+    def test_extract_without_sendfile(self):
+        """Test extraction falls back to pread/pwrite if sendfile fails too."""
+        self._check_extract_fallback("copy_file_range", "sendfile")
+
     def test_extract_past_eof(self):
         """Test extraction when size extends past EOF."""
         src = os.path.join(self.test_dir, "source.bin")
@@ -326,15 +485,16 @@ class TestExtractPartOfFile(unittest.TestCase):
         regions: tuples of (offset, data) where data is written at offset.
         Gaps between regions become sparse holes.
         """
-        with open(path, "wb") as f:
-            for offset, data in regions:
-                f.seek(offset)
-                f.write(data)
-            # Use truncate via os.ftruncate to create sparse file
-            fd = f.fileno()
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Set the final size first, then fill in the data regions
             if regions:
                 max_offset = max(offset + len(data) for offset, data in regions)
                 os.ftruncate(fd, max_offset)
+            for offset, data in regions:
+                os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
 
     def test_extract_sparse_file(self):
         """Test extracting sparse file preserves holes."""
@@ -451,11 +611,9 @@ class TestExtractPartOfFile(unittest.TestCase):
 
         # Create 10MB file
         size = 10 * 1024 * 1024
-        chunk = b"A" * (1024 * 1024)
 
         with open(src, "wb") as f:
-            for _ in range(10):
-                f.write(chunk)
+            f.write(b"A" * size)
 
         written = utils.extract_part_of_file(src, dst, 0, size)
 
@@ -480,8 +638,6 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_sparse_file(self):
         """Test converting sparse file to Android sparse image format."""
-        import struct
-
         src = os.path.join(self.test_dir, "source.bin")
         dst = os.path.join(self.test_dir, "dest.simg")
 
@@ -504,7 +660,7 @@ class TestExtractPartOfFile(unittest.TestCase):
                 total_blks,
                 total_chunks,
                 checksum,
-            ) = struct.unpack("<IHHHHIIII", header)
+            ) = SPARSE_HEADER.unpack(header)
 
             self.assertEqual(magic, 0xED26FF3A)
             self.assertEqual(major, 1)
@@ -515,19 +671,19 @@ class TestExtractPartOfFile(unittest.TestCase):
             self.assertEqual(total_chunks, 3)  # data, hole, data
 
             # Read first chunk (data)
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC1)  # RAW
             self.assertEqual(chunk_hdr[2], 2)  # 2 blocks (8192 bytes)
             data = f.read(8192)
             self.assertEqual(data, b"A" * 8192)
 
             # Read second chunk (hole)
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC3)  # DONT_CARE
             self.assertEqual(chunk_hdr[3], 12)  # header only, no data
 
             # Read third chunk (data)
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC1)  # RAW
             self.assertEqual(chunk_hdr[2], 1)  # 1 block (4096 bytes)
             data = f.read(4096)
@@ -535,8 +691,6 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_no_holes(self):
         """Test converting non-sparse file to simg."""
-        import struct
-
         src = os.path.join(self.test_dir, "source.bin")
         dst = os.path.join(self.test_dir, "dest.simg")
 
@@ -546,17 +700,15 @@ class TestExtractPartOfFile(unittest.TestCase):
         utils.convert_to_simg(src, dst)
 
         with open(dst, "rb") as f:
-            header = struct.unpack("<IHHHHIIII", f.read(28))
+            header = SPARSE_HEADER.unpack(f.read(28))
             self.assertEqual(header[7], 1)  # total_chunks = 1 (just data)
 
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC1)  # RAW
             self.assertEqual(chunk_hdr[2], 2)  # 2 blocks
 
     def test_convert_to_simg_all_sparse(self):
         """Test converting entirely sparse file to simg."""
-        import struct
-
         src = os.path.join(self.test_dir, "source.bin")
         dst = os.path.join(self.test_dir, "dest.simg")
 
@@ -567,10 +719,10 @@ class TestExtractPartOfFile(unittest.TestCase):
         utils.convert_to_simg(src, dst)
 
         with open(dst, "rb") as f:
-            header = struct.unpack("<IHHHHIIII", f.read(28))
+            header = SPARSE_HEADER.unpack(f.read(28))
             self.assertEqual(header[7], 1)  # total_chunks = 1 (just hole)
 
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC3)  # DONT_CARE
             self.assertEqual(chunk_hdr[2], 4)  # 4 blocks
 
@@ -585,8 +737,6 @@ class TestExtractPartOfFile(unittest.TestCase):
         With 4096-byte blocks, both block 0 and block 1 contain data,
         so there should be NO hole chunks - just 2 consecutive data blocks.
         """
-        import struct
-
         src = os.path.join(self.test_dir, "source.bin")
         dst = os.path.join(self.test_dir, "dest.simg")
 
@@ -602,7 +752,7 @@ class TestExtractPartOfFile(unittest.TestCase):
         # Verify sparse image structure
         with open(dst, "rb") as f:
             # Read header
-            header = struct.unpack("<IHHHHIIII", f.read(28))
+            header = SPARSE_HEADER.unpack(f.read(28))
             (
                 magic,
                 major,
@@ -623,7 +773,7 @@ class TestExtractPartOfFile(unittest.TestCase):
             self.assertEqual(total_chunks, 1)
 
             # Read the single chunk (should be RAW type)
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             chunk_type, reserved, chunk_sz, total_sz = chunk_hdr
 
             self.assertEqual(chunk_type, 0xCAC1)  # RAW
@@ -631,15 +781,13 @@ class TestExtractPartOfFile(unittest.TestCase):
             self.assertEqual(total_sz, 12 + 2 * 4096)  # header + 2 blocks of data
 
         # Also validate with simg2img if available
-        import shutil
-        import subprocess
 
-        if shutil.which("simg2img"):
+        if SIMG2IMG:
             restored = os.path.join(self.test_dir, "restored.bin")
             result = subprocess.run(
-                ["simg2img", dst, restored],
-                capture_output=True,
-                text=True,
+                [SIMG2IMG, dst, restored],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
             )
             self.assertEqual(result.returncode, 0)
 
@@ -655,8 +803,6 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_zero_filled_blocks(self):
         """Test that zero-filled blocks generate FILL chunks."""
-        import struct
-
         src = os.path.join(self.test_dir, "source.bin")
         dst = os.path.join(self.test_dir, "dest.simg")
 
@@ -674,7 +820,7 @@ class TestExtractPartOfFile(unittest.TestCase):
         # Verify the sparse image structure
         with open(dst, "rb") as f:
             # Read header
-            header = struct.unpack("<IHHHHIIII", f.read(28))
+            header = SPARSE_HEADER.unpack(f.read(28))
             (
                 magic,
                 major,
@@ -694,14 +840,14 @@ class TestExtractPartOfFile(unittest.TestCase):
             self.assertEqual(total_chunks, 3)
 
             # First chunk: RAW (1 block of 'A')
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC1)  # RAW
             self.assertEqual(chunk_hdr[2], 1)  # 1 block
             data = f.read(4096)
             self.assertEqual(data, b"A" * 4096)
 
             # Second chunk: FILL (10 blocks of zeros)
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC2)  # FILL
             self.assertEqual(chunk_hdr[2], 10)  # 10 blocks
             self.assertEqual(chunk_hdr[3], 16)  # total_sz = 12 + 4
@@ -709,7 +855,7 @@ class TestExtractPartOfFile(unittest.TestCase):
             self.assertEqual(fill_value, 0)
 
             # Third chunk: RAW (1 block of 'B')
-            chunk_hdr = struct.unpack("<HHII", f.read(12))
+            chunk_hdr = CHUNK_HEADER.unpack(f.read(12))
             self.assertEqual(chunk_hdr[0], 0xCAC1)  # RAW
             self.assertEqual(chunk_hdr[2], 1)  # 1 block
             data = f.read(4096)
@@ -717,11 +863,8 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_validate_with_simg2img(self):
         """Test conversion validation using android-tools simg2img."""
-        import shutil
-        import subprocess
 
-        # Check if simg2img is available
-        if not shutil.which("simg2img"):
+        if not SIMG2IMG:
             self.skipTest("simg2img not available")
 
         src = os.path.join(self.test_dir, "source.bin")
@@ -741,11 +884,15 @@ class TestExtractPartOfFile(unittest.TestCase):
 
         # Convert back using simg2img
         result = subprocess.run(
-            ["simg2img", simg, restored],
-            capture_output=True,
-            text=True,
+            [SIMG2IMG, simg, restored],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(
+            result.returncode,
+            0,
+            f"simg2img failed: {result.stderr.decode(errors='replace')}",
         )
-        self.assertEqual(result.returncode, 0, f"simg2img failed: {result.stderr}")
 
         # Android sparse format only stores block count, not exact byte size
         # So restored file may be block-aligned (larger than original)
@@ -766,10 +913,8 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_validate_nonsparse(self):
         """Test conversion of non-sparse file with simg2img validation."""
-        import shutil
-        import subprocess
 
-        if not shutil.which("simg2img"):
+        if not SIMG2IMG:
             self.skipTest("simg2img not available")
 
         src = os.path.join(self.test_dir, "source.bin")
@@ -785,11 +930,15 @@ class TestExtractPartOfFile(unittest.TestCase):
 
         # Convert back
         result = subprocess.run(
-            ["simg2img", simg, restored],
-            capture_output=True,
-            text=True,
+            [SIMG2IMG, simg, restored],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(
+            result.returncode,
+            0,
+            f"simg2img failed: {result.stderr.decode(errors='replace')}",
         )
-        self.assertEqual(result.returncode, 0, f"simg2img failed: {result.stderr}")
 
         # Verify exact match
         with open(src, "rb") as f1, open(restored, "rb") as f2:
@@ -797,10 +946,8 @@ class TestExtractPartOfFile(unittest.TestCase):
 
     def test_convert_to_simg_validate_large_sparse(self):
         """Test conversion of large sparse file with simg2img validation."""
-        import shutil
-        import subprocess
 
-        if not shutil.which("simg2img"):
+        if not SIMG2IMG:
             self.skipTest("simg2img not available")
 
         src = os.path.join(self.test_dir, "source.bin")
@@ -825,11 +972,15 @@ class TestExtractPartOfFile(unittest.TestCase):
 
         # Convert back
         result = subprocess.run(
-            ["simg2img", simg, restored],
-            capture_output=True,
-            text=True,
+            [SIMG2IMG, simg, restored],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self.assertEqual(
+            result.returncode,
+            0,
+            f"simg2img failed: {result.stderr.decode(errors='replace')}",
         )
-        self.assertEqual(result.returncode, 0, f"simg2img failed: {result.stderr}")
 
         # Verify size
         self.assertEqual(os.path.getsize(restored), src_size)
@@ -20,29 +20,18 @@ def extract_comment_header(file):
             break
         lines.append(line[1:])
 
-    # Unindent
-    min_indent = -1
-    for line in lines:
-        indent = 0
-        for c in line:
-            if c == " ":
-                indent = indent + 1
-            else:
-                if min_indent < 0:
-                    min_indent = indent
-                else:
-                    min_indent = min(indent, min_indent)
-                break
+    # Unindent, ignoring lines that are all spaces
+    min_indent = min(
+        (len(line) - len(line.lstrip(" ")) for line in lines if line.strip(" ")),
+        default=-1,
+    )
 
     if min_indent > 0:
         for i in range(len(lines)):
             lines[i] = lines[i][min_indent:]
 
     # Remove trailing empty lines
-    while len(lines) > 0 and lines[-1] == "":
-        lines.pop()
-
-    return "\n".join(lines)
+    return "\n".join(lines).rstrip("\n")
 
 
 def get_osbuild_major_version(runner, use_container):
@@ -50,11 +39,25 @@ def get_osbuild_major_version(runner, use_container):
         ["/usr/bin/osbuild", "--version"],
         capture_output=True,
     )
-    osbuild_major_version = osbuild_version.split()[-1].split(".")[0]
+    osbuild_major_version = osbuild_version.rsplit(None, 1)[-1].partition(".")[0]
 
     return int(osbuild_major_version)
 
 
+_INITRD_MAGICS = (
+    # Other common ones, by prefix (lz4 is handled separately)
+    (b"\x1f\x8b", "gzip"),
+    (b"\xfd\x37\x7a\x58\x5a\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"BZh", "bzip2"),
+    # Raw/uncompressed newc cpio (ASCII)
+    (b"070701", "cpio"),
+    (b"070702", "cpio"),
+    # lzo/lzop (less common for initramfs, but seen)
+    (b"\x89LZO\x00\x0d\x0a\x1a\x0a", "lzo"),
+)
+
+
 def detect_initrd_compression(path):
     with open(path, "rb") as f:
         head = f.read(16)
@@ -72,101 +75,92 @@ def detect_initrd_compression(path):
     if 0x184D2A50 <= magic32 <= 0x184D2A5F:  # P* M 18 .. P/*M18
         return "lz4-skippable"
 
-    # Other common ones
-    if head.startswith(b"\x1f\x8b"):
-        return "gzip"
-    if head.startswith(b"\xfd\x37\x7a\x58\x5a\x00"):
-        return "xz"
-    if head.startswith(b"\x28\xb5\x2f\xfd"):
-        return "zstd"
-    if head.startswith(b"BZh"):
-        return "bzip2"
+    for magic, kind in _INITRD_MAGICS:
+        if head.startswith(magic):
+            return kind
 
-    # Raw/uncompressed newc cpio (ASCII)
-    if head.startswith(b"070701") or head.startswith(b"070702"):
-        return "cpio"
+    return "unknown"
 
-    # lzo/lzop (less common for initramfs, but seen)
-    if head.startswith(b"\x89LZO\x00\x0d\x0a\x1a\x0a"):
-        return "lzo"
 
-    return "unknown"
+_INITRD_COMPRESSORS = {
+    "gzip": ("gzip", "-c"),
+    "xz": ("xz", "-C", "crc32", "-z", "-c"),
+    "zstd": ("zstd", "-q", "-c"),
+    "lz4": ("lz4", "-9", "-c"),  # modern
+    "lz4-legacy": ("lz4", "-l", "-9", "-c"),  # legacy: note the -l
+    "bzip2": ("bzip2", "-c"),
+    "cpio": (),  # no compression; append raw cpio
+    "lzo": ("lzop", "-c"),
+}
 
 
 def initrd_compressor_for(kind):
-    if kind == "gzip":
-        return ["gzip", "-c"]
-    if kind == "xz":
-        return ["xz", "-C", "crc32", "-z", "-c"]
-    if kind == "zstd":
-        return ["zstd", "-q", "-c"]
-    if kind == "lz4":
-        return ["lz4", "-9", "-c"]  # modern
-    if kind == "lz4-legacy":
-        return ["lz4", "-l", "-9", "-c"]  # legacy: note the -l
-    if kind == "bzip2":
-        return ["bzip2", "-c"]
-    if kind == "cpio":
-        return []  # no compression; append raw cpio
-    if kind == "lzo":
-        return ["lzop", "-c"]
-    raise RuntimeError(f"Unsupported/unknown compression: {kind}")
+    try:
+        return list(_INITRD_COMPRESSORS[kind])
+    except KeyError:
+        raise RuntimeError(f"Unsupported/unknown compression: {kind}")
 
 
 def create_cpio_archive(dest, basedir, files, compression):
-    # Start up cpio
-    cpio_cmd = ["cpio", "--null", "-o", "-H", "newc", "--owner", "0:0"]
+    # Look up the compressor first, so unknown kinds fail before dest exists
+    comp_cmd = initrd_compressor_for(compression)
     try:
-        cpio_proc = subprocess.Popen(
-            cpio_cmd,
-            cwd=basedir,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-    except FileNotFoundError:
-        raise RuntimeError("cpio not found in PATH")
+        _write_cpio_archive(dest, basedir, files, compression, comp_cmd)
+    except BaseException:
+        # Don't leave an empty or partial archive behind
+        rm_rf(dest)
+        raise
 
-    # Stream files to cpio, and then close stdin
-    assert cpio_proc.stdin is not None
-    cpio_proc.stdin.write(b"\x00".join(p.encode() for p in files) + b"\x00")
-    cpio_proc.stdin.close()
 
-    comp_cmd = initrd_compressor_for(compression)
+def _write_cpio_archive(dest, basedir, files, compression, comp_cmd):
+    cpio_cmd = ["cpio", "--null", "-o", "-H", "newc", "--owner", "0:0"]
     comp_proc = None
-    if comp_cmd:
+
+    # The last process in the pipeline writes directly to dest, so the
+    # archive data never passes through python
+    with open(dest, "wb") as out:
+        # Start up cpio
         try:
-            comp_proc = subprocess.Popen(
-                comp_cmd,
-                stdin=cpio_proc.stdout,
-                stdout=subprocess.PIPE,
+            cpio_proc = subprocess.Popen(
+                cpio_cmd,
+                cwd=basedir,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE if comp_cmd else out,
                 stderr=subprocess.PIPE,
             )
-        except FileNotFoundError as e:
-            cpio_proc.kill()
-            raise RuntimeError(
-                f"compressor missing for {compression}: {comp_cmd[0]}"
-            ) from e
-
-        cpio_proc.stdout.close()  # Owned by compressor now
-        pipe_stdout = comp_proc.stdout
-    else:
-        pipe_stdout = cpio_proc.stdout
-
-    # Write pipeline output to dest
-    with open(dest, "wb") as out:
-        shutil.copyfileobj(pipe_stdout, out, length=1024 * 1024)
-    pipe_stdout.close()
+        except FileNotFoundError:
+            raise RuntimeError("cpio not found in PATH")
+
+        if comp_cmd:
+            try:
+                comp_proc = subprocess.Popen(
+                    comp_cmd,
+                    stdin=cpio_proc.stdout,
+                    stdout=out,
+                    stderr=subprocess.PIPE,
+                )
+            except FileNotFoundError as e:
+                cpio_proc.kill()
+                cpio_proc.wait()
+                raise RuntimeError(
+                    f"compressor missing for {compression}: {comp_cmd[0]}"
+                ) from e
+
+            cpio_proc.stdout.close()  # Owned by compressor now
+
+    # Send the file list to cpio, reading its stderr at the same time so
+    # that it can't block on a full stderr pipe
+    _, cpio_stderr = cpio_proc.communicate(
+        b"\x00".join(p.encode() for p in files) + b"\x00"
+    )
+    cpio_rc = cpio_proc.returncode
+    cpio_stderr = cpio_stderr.decode(errors="ignore")
 
     comp_rc = 0
     if comp_proc:
         comp_stdout, comp_stderr = comp_proc.communicate()
         comp_rc = comp_proc.returncode
 
-    # Note: We can't user cpio_proc.communicate() here because we closed stdin
-    cpio_rc = cpio_proc.wait()
-    cpio_stderr = cpio_proc.stderr.read().decode(errors="ignore")
-
     if cpio_rc != 0:
         raise RuntimeError(f"cpio failed (rc={cpio_rc}): {cpio_stderr}")
 
@@ -197,13 +191,28 @@ def read_public_key(pemfile, passargs=None):
 
 
 def read_keys(pemfile, passargs=None):
-    # Extract the seed/public parts from generated key (last 32 byte in PEM file)
-    pubkey = openssl_stdout(
-        "pkey", "-outform", "DER", "-pubout", "-in", pemfile, passargs=passargs
-    )[-32:]
-    seed = openssl_stdout("pkey", "-outform", "DER", "-in", pemfile, passargs=passargs)[
-        -32:
-    ]
+    # Dump the seed ("priv") and public ("pub") parts of the key with a
+    # single openssl run, each is printed as colon separated hex bytes
+    text = openssl_stdout(
+        "pkey", "-text", "-noout", "-in", pemfile, passargs=passargs
+    ).decode("utf8")
+    parts = {}
+    section = None
+    for line in text.splitlines():
+        if line[:1].isspace():
+            if section is not None:
+                parts[section] += line.strip().replace(":", "")
+        else:
+            section = line.rstrip(":")
+            parts[section] = ""
+
+    try:
+        pubkey = bytes.fromhex(parts["pub"])
+        seed = bytes.fromhex(parts["priv"])
+    except (KeyError, ValueError):
+        pubkey = seed = b""
+    if len(pubkey) != 32 or len(seed) != 32:
+        raise RuntimeError(f"Failed to read ed25519 key from {pemfile}")
 
     # Private key is seed and public key joined
     seckey = seed + pubkey
@@ -292,6 +301,47 @@ class SudoTemporaryDirectory:
         # Require minimum length to avoid deleting very short critical paths
         return len(str(rp)) > len(str(self._base)) + 3
 
+    # Like shutil.rmtree(), but on failure make the directories involved
+    # accessible and retry. This handles read-only directories (e.g. from
+    # container builds) that we own without having to use sudo.
+    def _rmtree(self, top):
+        top = str(top)
+
+        retried = set()
+
+        def force(func, path, exc):
+            # Before 3.12 (onerror) we get sys.exc_info() rather than the error
+            if isinstance(exc, tuple):
+                exc = exc[1]
+            if isinstance(exc, FileNotFoundError):
+                return  # Already removed, e.g. by a retry below
+            # Only permission errors can be fixed here, and only once per path
+            if not isinstance(exc, PermissionError) or path in retried:
+                raise exc
+            retried.add(path)
+
+            try:
+                # Never touch the permissions of anything outside top
+                if path != top:
+                    os.chmod(os.path.dirname(path), 0o700)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.chmod(path, 0o700)
+                    if func is not os.rmdir:
+                        # Listing the directory failed, remove it all again
+                        rmtree(path)
+                        return
+                func(path)
+            except FileNotFoundError:
+                pass
+
+        def rmtree(path):
+            if sys.version_info >= (3, 12):
+                shutil.rmtree(path, onexc=force)
+            else:
+                shutil.rmtree(path, onerror=force)
+
+        rmtree(top)
+
     def cleanup(self):
         if self._closed:
             return
@@ -303,7 +353,7 @@ class SudoTemporaryDirectory:
 
         # Try normal deletion first
         try:
-            shutil.rmtree(p)
+            self._rmtree(p)
             return
         except (OSError, PermissionError) as e:
             last_err = e
@@ -334,12 +384,20 @@ class SudoTemporaryDirectory:
         return self._path
 
 
+_ZERO_BLOCK = bytes(4096)
+
+
 def count_trailing_zeros(b: bytes) -> int:
     mv = memoryview(b)
-    i = len(mv) - 1
-    while i >= 0 and mv[i] == 0:
-        i -= 1
-    return len(mv) - 1 - i
+    if not mv or mv[-1] != 0:
+        return 0
+    bs = len(_ZERO_BLOCK)
+    # Skip whole zero blocks from the end, then strip the partial block
+    end = len(mv)
+    while end >= bs and mv[end - bs : end] == _ZERO_BLOCK:
+        end -= bs
+    tail = mv[max(0, end - bs) : end].tobytes()
+    return len(mv) - end + len(tail) - len(tail.rstrip(b"\x00"))
 
 
 def truncate_partition_size(src_path: str, start: int, size: int, block_size=4096):
@@ -351,6 +409,15 @@ def truncate_partition_size(src_path: str, start: int, size: int, block_size=409
     with open(src_path, "rb") as src:
         src_fd = src.fileno()
         end = start + size
+
+        # Common case: the partition ends with data, so there is no need
+        # to walk all the extents looking for the last one
+        try:
+            if size > 0 and os.lseek(src_fd, end - 1, os.SEEK_DATA) == end - 1:
+                return size
+        except OSError:
+            pass
+
         pos = start
         last_data_end = None
 
@@ -387,9 +454,93 @@ def truncate_partition_size(src_path: str, start: int, size: int, block_size=409
 
 
 def roundup(n: int, block: int) -> int:
+    # Block sizes are normally powers of two, where masking avoids a division
+    if block > 0 and block & (block - 1) == 0:
+        return (n + block - 1) & ~(block - 1)
     return ((n + block - 1) // block) * block
 
 
+# Errors from copy_file_range() and sendfile() that mean the call is not
+# supported for these files, rather than an actual I/O error.
+_COPY_UNSUPPORTED_ERRNOS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.ENOTSUP,
+    getattr(errno, "EOPNOTSUPP", 95),
+)
+
+
+# Copies length bytes at src_offset to dst_offset, returning the number of
+# bytes copied (less than length if src ends first). This uses
+# copy_file_range() so the data doesn't pass through userspace (and may
+# even be reflinked). Where that is not supported, such as across
+# filesystems on older kernels, it falls back to sendfile(), which also
+# copies in the kernel, and finally to pread()/pwrite().
+def _copy_file_range(
+    src_fd: int,
+    dst_fd: int,
+    src_offset: int,
+    dst_offset: int,
+    length: int,
+    chunk_size: int,
+) -> int:
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(
+                    src_fd,
+                    dst_fd,
+                    length - copied,
+                    src_offset + copied,
+                    dst_offset + copied,
+                )
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            # sendfile() writes at the current position of dst_fd
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, src_offset + copied, length - copied)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED_ERRNOS:
+                raise
+
+    # Read into one reused buffer rather than allocating a new bytes per chunk
+    buf = memoryview(bytearray(min(chunk_size, length - copied)))
+    while copied < length:
+        to_read = min(len(buf), length - copied)
+        n = os.preadv(src_fd, [buf[:to_read]], src_offset + copied)
+        if n == 0:
+            break
+        os.pwrite(dst_fd, buf[:n], dst_offset + copied)
+        copied += n
+    return copied
+
+
+# Give the kernel a hint about how we access a file. This is only an
+# optimization, so it is ignored where posix_fadvise() isn't available.
+def _fadvise(fd: int, offset: int, length: int, advice: str):
+    if not hasattr(os, "posix_fadvise") or not hasattr(os, advice):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass
+
+
 # This extracts part of a file, typically used
 # to exctract partitions from a complete image file.
 def extract_part_of_file(
@@ -407,6 +558,15 @@ def extract_part_of_file(
         end = start + size
         pos = start
 
+        # The source range is read once, front to back
+        _fadvise(src_fd, start, size, "POSIX_FADV_SEQUENTIAL")
+
+        # Set the final size up front, so the copies below don't have to
+        # extend the file, and it has the correct size even if it ends
+        # with a hole
+        if size > 0:
+            os.ftruncate(dst_fd, size)
+
         while pos < end:
             try:
                 data_start = os.lseek(src_fd, pos, os.SEEK_DATA)
@@ -423,31 +583,28 @@ def extract_part_of_file(
 
             hole_start = min(hole_start, end)
 
-            data_size = hole_start - data_start
-            dst_offset = data_start - start
-
-            os.lseek(src_fd, data_start, os.SEEK_SET)
-            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
-
-            remaining = data_size
-            while remaining > 0:
-                to_read = min(chunk_size, remaining)
-                data = os.read(src_fd, to_read)
-                if not data:
-                    break
-                os.write(dst_fd, data)
-                total_written += len(data)
-                remaining -= len(data)
+            total_written += _copy_file_range(
+                src_fd,
+                dst_fd,
+                data_start,
+                data_start - start,
+                hole_start - data_start,
+                chunk_size,
+            )
 
             pos = hole_start
 
-        # Ensure destination file has the correct size, even if it ends with a hole
-        if size > 0:
-            os.ftruncate(dst_fd, size)
+        # We won't read this part of the source again, don't keep it cached
+        _fadvise(src_fd, start, size, "POSIX_FADV_DONTNEED")
 
     return total_written
 
 
+_SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+_CHUNK_HEADER = struct.Struct("<HHII")
+_FILL_ZERO = struct.pack("<I", 0)
+
+
 def convert_to_simg(src_path: str, dst_path: str, block_size: int = 4096):
     """
     Convert file to Android sparse image (v1.0).
@@ -468,84 +625,123 @@ def convert_to_simg(src_path: str, dst_path: str, block_size: int = 4096):
     file_size = os.path.getsize(src_path)
     total_blocks = (file_size + block_size - 1) // block_size
 
-    def block_has_data(fd, block_idx):
-        start = block_idx * block_size
-        end = min(start + block_size, file_size)
-        if start >= file_size:
-            return False  # beyond EOF: treat as hole (but typically no chunks past total_blocks)
-        try:
-            off = os.lseek(fd, start, os.SEEK_DATA)
-            return off < end
-        except OSError as e:
-            if e.errno in (errno.ENXIO,):  # no more data past 'start'
-                return False
-            if e.errno in (
-                errno.EINVAL,
-                errno.ENOTSUP,
-                getattr(errno, "EOPNOTSUPP", 95),
-            ):
-                raise OSError("Filesystem does not support SEEK_DATA/SEEK_HOLE") from e
-            raise
-
-    # Collect chunks of blocks with their type (data or hole)
-    chunks = []
-    with open(src_path, "rb") as src:
-        fd = src.fileno()
-        i = 0
-        while i < total_blocks:
-            has_data = block_has_data(fd, i)
-            j = i + 1
-            while j < total_blocks and block_has_data(fd, j) == has_data:
-                j += 1
-
-            chunks.append(("data" if has_data else "hole", i, j - i))
-            i = j
-
-    def is_all_zeros(data: memoryview) -> bool:
-        for x in data:
-            if x:
-                return False
-        return True
-
-    # Write sparse image directly to destination
-    def analyze_block_runs(buf: bytes, block_size: int):
+    def data_extents(fd):
+        pos = 0
+        while pos < file_size:
+            try:
+                data_start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno in (errno.ENXIO,):  # no more data past 'pos'
+                    return
+                if e.errno in (
+                    errno.EINVAL,
+                    errno.ENOTSUP,
+                    getattr(errno, "EOPNOTSUPP", 95),
+                ):
+                    raise OSError(
+                        "Filesystem does not support SEEK_DATA/SEEK_HOLE"
+                    ) from e
+                raise
+            data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+            yield data_start, data_end
+            pos = data_end
+
+    zero_block = bytes(block_size)
+
+    # Split the first size bytes (whole blocks) of a buffer into runs of
+    # zero and non-zero blocks
+    def analyze_block_runs(buf: bytearray, size: int, block_size: int):
         runs = []
-        total_blocks = len(buf) // block_size
         mv = memoryview(buf)
 
-        block_idx = 0
-        while block_idx < total_blocks:
-            block_start = block_idx * block_size
-            block_end = block_start + block_size
-            block_data = mv[block_start:block_end]
-            is_zero = is_all_zeros(block_data)
-
-            # Find consecutive blocks of same type
-            run_length = 1
-            while block_idx + run_length < total_blocks:
-                next_start = (block_idx + run_length) * block_size
-                next_end = next_start + block_size
-                next_block = mv[next_start:next_end]
-                next_is_zero = is_all_zeros(next_block)
-
-                if next_is_zero == is_zero:
-                    run_length += 1
+        # Comparing bytes slices is a memcmp(), which is much faster than
+        # looking at each byte (or comparing memoryviews)
+        run_start = 0
+        run_is_zero = None
+        for offset in range(0, size, block_size):
+            is_zero = buf[offset : offset + block_size] == zero_block
+            if is_zero != run_is_zero:
+                if run_is_zero is not None:
+                    runs.append(
+                        (
+                            run_is_zero,
+                            (offset - run_start) // block_size,
+                            mv[run_start:offset],
+                        )
+                    )
+                run_start = offset
+                run_is_zero = is_zero
+        if run_is_zero is not None:
+            runs.append(
+                (
+                    run_is_zero,
+                    (size - run_start) // block_size,
+                    mv[run_start:size],
+                )
+            )
+
+        return runs
+
+    # Data is read into one reused buffer rather than into a new bytes
+    # object for every chunk, which saves faulting in fresh pages each time
+    read_chunk_size = 32 * 1024  # Read 32k blocks at a time (128MB with 4K blocks)
+    read_buf = bytearray(min(read_chunk_size, total_blocks) * block_size)
+    read_view = memoryview(read_buf)
+
+    # Stream a data chunk, detecting zero-filled blocks on the fly.
+    # Returns the number of sparse chunks written.
+    def write_data(src, dst, start_blk: int, n_blocks: int) -> int:
+        count = 0
+        src.seek(start_blk * block_size)
+        blocks_remaining = n_blocks
+
+        while blocks_remaining > 0:
+            blocks_to_read = min(read_chunk_size, blocks_remaining)
+            chunk_size = blocks_to_read * block_size
+            n_read = src.readinto(read_view[:chunk_size])
+
+            # Pad if needed
+            if n_read < chunk_size:
+                read_buf[n_read:chunk_size] = bytes(chunk_size - n_read)
+
+            for is_zero, run_length, run in analyze_block_runs(
+                read_buf, chunk_size, block_size
+            ):
+                if is_zero:
+                    chunk_header = _CHUNK_HEADER.pack(
+                        CHUNK_TYPE_FILL, 0, run_length, 16
+                    )
+                    dst.write(chunk_header)
+                    dst.write(_FILL_ZERO)
                 else:
-                    break
+                    chunk_header = _CHUNK_HEADER.pack(
+                        CHUNK_TYPE_RAW,
+                        0,
+                        run_length,
+                        12 + len(run),
+                    )
+                    dst.write(chunk_header)
+                    dst.write(run)
 
-            run_end = block_start + run_length * block_size
-            run = mv[block_start:run_end]
-            runs.append((is_zero, run_length, run))
+                count += 1
 
-            block_idx += run_length
+            blocks_remaining -= blocks_to_read
 
-        return runs
+        return count
+
+    def write_hole(dst, n_blocks: int) -> int:
+        dst.write(_CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, n_blocks, 12))
+        return 1
 
     chunk_count = 0
-    with open(dst_path, "wb") as dst:
+    # Use a large buffer so the many small chunk headers are batched into
+    # few writes. Raw payloads larger than the buffer are written directly
+    # from the read buffer without another copy.
+    with open(src_path, "rb") as src, open(
+        dst_path, "wb", buffering=1024 * 1024
+    ) as dst:
         # Write placeholder header (we'll update chunk_count later)
-        sparse_header = struct.pack(
-            "<IHHHHIIII",
+        sparse_header = _SPARSE_HEADER.pack(
             SPARSE_HEADER_MAGIC,
             1,  # major_version
             0,  # minor_version
@@ -558,60 +754,33 @@ def convert_to_simg(src_path: str, dst_path: str, block_size: int = 4096):
         )
         dst.write(sparse_header)
 
-        with open(src_path, "rb") as src:
-            for kind, start_blk, n_blocks in chunks:
-                if kind == "hole":
-                    chunk_header = struct.pack(
-                        "<HHII", CHUNK_TYPE_DONT_CARE, 0, n_blocks, 12
-                    )
-                    dst.write(chunk_header)
-                    chunk_count += 1
-                else:
-                    # Stream data chunk, detecting zero-filled blocks on the fly
-                    src.seek(start_blk * block_size)
-                    blocks_remaining = n_blocks
-                    read_chunk_size = (
-                        32 * 1024
-                    )  # Read 32k blocks at a time (128MB with 4K blocks)
-
-                    while blocks_remaining > 0:
-                        blocks_to_read = min(read_chunk_size, blocks_remaining)
-                        chunk_data = src.read(blocks_to_read * block_size)
-
-                        # Pad if needed
-                        if len(chunk_data) < blocks_to_read * block_size:
-                            chunk_data += b"\x00" * (
-                                blocks_to_read * block_size - len(chunk_data)
-                            )
-
-                        for is_zero, run_length, run in analyze_block_runs(
-                            chunk_data, block_size
-                        ):
-                            if is_zero:
-                                chunk_header = struct.pack(
-                                    "<HHII", CHUNK_TYPE_FILL, 0, run_length, 16
-                                )
-                                dst.write(chunk_header)
-                                dst.write(struct.pack("<I", 0))
-                            else:
-                                chunk_header = struct.pack(
-                                    "<HHII",
-                                    CHUNK_TYPE_RAW,
-                                    0,
-                                    run_length,
-                                    12 + len(run),
-                                )
-                                dst.write(chunk_header)
-                                dst.write(run)
-
-                            chunk_count += 1
-
-                        blocks_remaining -= blocks_to_read
+        # Walk the data extents once, writing holes for the gaps between
+        # them. A block is data if any part of it is in a data extent, so
+        # extents sharing a block are merged before the data is written.
+        next_blk = 0
+        pending = None  # (start_blk, n_blocks) of data not yet written
+        for data_start, data_end in data_extents(src.fileno()):
+            first_blk = data_start // block_size
+            end_blk = min((data_end + block_size - 1) // block_size, total_blocks)
+            if pending and first_blk <= next_blk:
+                # Extent starts in (or right after) the pending data chunk
+                pending = (pending[0], end_blk - pending[0])
+                next_blk = end_blk
+                continue
+            if pending:
+                chunk_count += write_data(src, dst, *pending)
+            if first_blk > next_blk:
+                chunk_count += write_hole(dst, first_blk - next_blk)
+            pending = (first_blk, end_blk - first_blk)
+            next_blk = end_blk
+        if pending:
+            chunk_count += write_data(src, dst, *pending)
+        if next_blk < total_blocks:
+            chunk_count += write_hole(dst, total_blocks - next_blk)
 
         # Seek back and update the header with correct chunk count
         dst.seek(0)
-        sparse_header = struct.pack(
-            "<IHHHHIIII",
+        sparse_header = _SPARSE_HEADER.pack(
             SPARSE_HEADER_MAGIC,
             1,  # major_version
             0,  # minor_version
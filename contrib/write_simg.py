@@ -5,6 +5,7 @@ write_simg.py - Write Android sparse image to block device
 
 import argparse
 import fcntl
+import functools
 import os
 import stat
 import struct
@@ -15,8 +16,17 @@ CHUNK_TYPE_RAW = 0xCAC1
 CHUNK_TYPE_FILL = 0xCAC2
 CHUNK_TYPE_DONT_CARE = 0xCAC3
 
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+CHUNK_HEADER = struct.Struct("<HHII")
+FILL_VALUE = struct.Struct("<I")
+
+BLKZEROOUT = 0x127F
+
 use_verbose = False
 
+# Reused for all RAW chunk data, rather than allocating new buffers
+copy_buffer = memoryview(bytearray(1024 * 1024))
+
 
 def verbose(str):
     if use_verbose:
@@ -34,6 +44,11 @@ def is_block_device(path):
 def get_block_device_size(path):
     with open(path, "rb") as f:
         fd = f.fileno()
+        # Seeking to the end gives the size of a block device on Linux
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size > 0:
+            return size
+
         BLKGETSIZE64 = 0x80081272
         size_bytes = fcntl.ioctl(fd, BLKGETSIZE64, b"\x00" * 8)
         return struct.unpack("Q", size_bytes)[0]
@@ -94,11 +109,11 @@ def get_block_device_info(path):
 
 
 def parse_simg_header(src):
-    header_data = src.read(28)
-    if len(header_data) < 28:
+    header_data = src.read(SPARSE_HEADER.size)
+    if len(header_data) < SPARSE_HEADER.size:
         raise ValueError("Invalid sparse image: header too short")
 
-    header = struct.unpack("<IHHHHIIII", header_data)
+    header = SPARSE_HEADER.unpack(header_data)
     (
         magic,
         major,
@@ -133,45 +148,161 @@ def parse_simg_header(src):
     }
 
 
-def write_raw_chunk(src, dst, chunk_idx, chunk_sz, total_sz, offset, block_size):
-    data_bytes = chunk_sz * block_size
-    if total_sz != 12 + data_bytes:
+def read_chunk_headers(src, hdr):
+    # Read and validate all chunk headers up front, so that broken images
+    # are detected before anything is written. Returns a list of
+    # (chunk_type, chunk_sz, data_offset) tuples.
+    block_size = hdr["block_size"]
+    src_size = os.fstat(src.fileno()).st_size
+
+    chunks = []
+    offset = src.tell()
+    current_block = 0
+    for chunk_idx in range(hdr["total_chunks"]):
+        src.seek(offset)
+        chunk_header = src.read(CHUNK_HEADER.size)
+        if len(chunk_header) < CHUNK_HEADER.size:
+            raise ValueError(f"Chunk {chunk_idx}: header too short")
+
+        chunk_type, reserved, chunk_sz, total_sz = CHUNK_HEADER.unpack(chunk_header)
+
+        if chunk_type == CHUNK_TYPE_RAW:
+            expected_sz = 12 + chunk_sz * block_size
+            if total_sz != expected_sz:
+                raise ValueError(
+                    f"Chunk {chunk_idx}: RAW total_sz mismatch: {total_sz} != {expected_sz}"
+                )
+        elif chunk_type == CHUNK_TYPE_FILL:
+            if total_sz != 16:
+                raise ValueError(
+                    f"Chunk {chunk_idx}: FILL total_sz should be 16, got {total_sz}"
+                )
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
+            if total_sz != 12:
+                raise ValueError(
+                    f"Chunk {chunk_idx}: DONT_CARE total_sz should be 12, got {total_sz}"
+                )
+        else:
+            raise ValueError(
+                f"Chunk {chunk_idx}: unknown chunk type 0x{chunk_type:04x}"
+            )
+
+        if offset + total_sz > src_size:
+            raise ValueError(f"Chunk {chunk_idx}: unexpected end of data")
+
+        chunks.append((chunk_type, chunk_sz, offset + CHUNK_HEADER.size))
+        offset += total_sz
+        current_block += chunk_sz
+
+    if current_block != hdr["total_blocks"]:
         raise ValueError(
-            f"Chunk {chunk_idx}: RAW total_sz mismatch: {total_sz} != {12 + data_bytes}"
+            f"Block count mismatch: processed {current_block}, expected {hdr['total_blocks']}"
         )
 
-    dst.seek(offset)
+    return chunks
 
-    remaining = data_bytes
-    while remaining > 0:
-        to_read = min(1024 * 1024, remaining)
-        data = src.read(to_read)
-        if len(data) != to_read:
-            raise ValueError(f"Chunk {chunk_idx}: unexpected end of data")
-        dst.write(data)
-        remaining -= to_read
 
-    verbose(f"Chunk {chunk_idx}: RAW {chunk_sz} blocks at offset {offset}")
-    return data_bytes
+@functools.lru_cache(maxsize=4)
+def block_batch(block):
+    # Images tend to use the same few fill values over and over, so keep
+    # the batches around rather than building one for each chunk
+    return memoryview(block * max(1, (8 * 1024 * 1024) // len(block)))
 
 
-def write_fill_chunk(src, dst, chunk_idx, chunk_sz, total_sz, offset, block_size):
-    if total_sz != 16:
-        raise ValueError(
-            f"Chunk {chunk_idx}: FILL total_sz should be 16, got {total_sz}"
+def write_blocks(dst, block, count):
+    # Write in large batches rather than one block at a time
+    batch = block_batch(block)
+    blocks_per_write = len(batch) // len(block)
+    full, rem = divmod(count, blocks_per_write)
+    for _ in range(full):
+        dst.write(batch)
+    if rem:
+        dst.write(batch[: rem * len(block)])
+
+
+def write_zeros(dst, offset, chunk_sz, block_size):
+    # Output files are created empty, so anything not written reads as zeros
+    if not stat.S_ISBLK(os.fstat(dst.fileno()).st_mode):
+        return
+
+    # Let the device zero the range if it can (e.g. using write zeroes),
+    # this avoids sending all the zero blocks to the device
+    dst.flush()
+    try:
+        fcntl.ioctl(
+            dst.fileno(),
+            BLKZEROOUT,
+            struct.pack("QQ", offset, chunk_sz * block_size),
         )
+        return
+    except OSError:
+        pass
 
-    fill_data = src.read(4)
-    if len(fill_data) != 4:
-        raise ValueError(f"Chunk {chunk_idx}: missing fill value")
+    dst.seek(offset)
+    write_blocks(dst, bytes(block_size), chunk_sz)
+
+
+def copy_file_range(src, dst, offset, length):
+    # Copy from the current src position to offset in dst in the kernel,
+    # returns False if this isn't possible and the data must be copied
+    if not hasattr(os, "copy_file_range"):
+        return False
+    if not stat.S_ISREG(os.fstat(dst.fileno()).st_mode):
+        return False
 
-    fill_value = struct.unpack("<I", fill_data)[0]
+    src_offset = src.tell()
+    copied = 0
+    try:
+        while copied < length:
+            n = os.copy_file_range(
+                src.fileno(),
+                dst.fileno(),
+                length - copied,
+                src_offset + copied,
+                offset + copied,
+            )
+            if n == 0:
+                return False  # Truncated image, let the caller report it
+            copied += n
+    except OSError:
+        return False
+
+    src.seek(src_offset + length)
+    return True
+
+
+def write_raw_chunk(src, dst, chunk_idx, chunk_sz, offset, block_size):
+    data_bytes = chunk_sz * block_size
 
     dst.seek(offset)
 
-    fill_block = struct.pack("<I", fill_value) * (block_size // 4)
-    for _ in range(chunk_sz):
-        dst.write(fill_block)
+    if not copy_file_range(src, dst, offset, data_bytes):
+        remaining = data_bytes
+        while remaining > 0:
+            to_read = min(len(copy_buffer), remaining)
+            data = copy_buffer[:to_read]
+            if src.readinto(data) != to_read:
+                raise ValueError(f"Chunk {chunk_idx}: unexpected end of data")
+            dst.write(data)
+            remaining -= to_read
+
+    verbose(f"Chunk {chunk_idx}: RAW {chunk_sz} blocks at offset {offset}")
+    return data_bytes
+
+
+def write_fill_chunk(src, dst, chunk_idx, chunk_sz, offset, block_size):
+    fill_data = src.read(FILL_VALUE.size)
+    if len(fill_data) != FILL_VALUE.size:
+        raise ValueError(f"Chunk {chunk_idx}: missing fill value")
+
+    (fill_value,) = FILL_VALUE.unpack(fill_data)
+
+    if fill_value == 0:
+        write_zeros(dst, offset, chunk_sz, block_size)
+    else:
+        dst.seek(offset)
+        fill_block = fill_data * (block_size // 4)
+        write_blocks(dst, fill_block, chunk_sz)
 
     verbose(
         f"Chunk {chunk_idx}: FILL {chunk_sz} blocks with 0x{fill_value:08x} at offset {offset}"
@@ -180,18 +311,10 @@ def write_fill_chunk(src, dst, chunk_idx, chunk_sz, total_sz, offset, block_size
 
 
 def write_dont_care_chunk(
-    dst, chunk_idx, chunk_sz, total_sz, offset, block_size, zero_initialize
+    dst, chunk_idx, chunk_sz, offset, block_size, zero_initialize
 ):
-    if total_sz != 12:
-        raise ValueError(
-            f"Chunk {chunk_idx}: DONT_CARE total_sz should be 12, got {total_sz}"
-        )
-
     if zero_initialize:
-        dst.seek(offset)
-        fill_block = struct.pack("<I", 0) * (block_size // 4)
-        for _ in range(chunk_sz):
-            dst.write(fill_block)
+        write_zeros(dst, offset, chunk_sz, block_size)
         verbose(
             f"Chunk {chunk_idx}: DONT_CARE {chunk_sz} blocks at offset {offset} (zeroed)"
         )
@@ -231,52 +354,31 @@ def write_simg(simg_path, output_path, is_block, zero_initialize):
         if is_block:
             print(f"Device size: {device_size} bytes ({device_size // (1024**3)} GB)")
 
+        chunks = read_chunk_headers(src, hdr)
+
         written_size = 0
         current_block = 0
-        for chunk_idx in range(total_chunks):
-            chunk_header = src.read(12)
-            if len(chunk_header) < 12:
-                raise ValueError(f"Chunk {chunk_idx}: header too short")
-
-            chunk_type, reserved, chunk_sz, total_sz = struct.unpack(
-                "<HHII", chunk_header
-            )
-
+        for chunk_idx, (chunk_type, chunk_sz, data_offset) in enumerate(chunks):
+            src.seek(data_offset)
             offset = current_block * block_size
 
             if chunk_type == CHUNK_TYPE_RAW:
                 written_size += write_raw_chunk(
-                    src, dst, chunk_idx, chunk_sz, total_sz, offset, block_size
+                    src, dst, chunk_idx, chunk_sz, offset, block_size
                 )
 
             elif chunk_type == CHUNK_TYPE_FILL:
                 written_size += write_fill_chunk(
-                    src, dst, chunk_idx, chunk_sz, total_sz, offset, block_size
-                )
-
-            elif chunk_type == CHUNK_TYPE_DONT_CARE:
-                written_size += write_dont_care_chunk(
-                    dst,
-                    chunk_idx,
-                    chunk_sz,
-                    total_sz,
-                    offset,
-                    block_size,
-                    zero_initialize,
+                    src, dst, chunk_idx, chunk_sz, offset, block_size
                 )
 
             else:
-                raise ValueError(
-                    f"Chunk {chunk_idx}: unknown chunk type 0x{chunk_type:04x}"
+                written_size += write_dont_care_chunk(
+                    dst, chunk_idx, chunk_sz, offset, block_size, zero_initialize
                 )
 
             current_block += chunk_sz
 
-        if current_block != total_blocks:
-            raise ValueError(
-                f"Block count mismatch: processed {current_block}, expected {total_blocks}"
-            )
-
         if not is_block:
             os.ftruncate(dst.fileno(), image_size)
 